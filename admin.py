@@ -1,13 +1,20 @@
 """Admin for a orchestra season."""
 
 from django.contrib import admin
-from django.contrib.admin import ModelAdmin
+from django.contrib.admin import ModelAdmin, SimpleListFilter
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
-from django.urls import reverse
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
 from django.utils.html import format_html
 from alumnisite.tools import ExportCsvMixin
 from .models import Location, PriceCategory, Production, Performance, \
-    Ticket, OnlineOrder
+    SeatHold, Ticket, OnlineOrder, OutgoingMail, ScanEvent
+from .bank import mark_payed, import_statement, report_lines
+from .forms import BankStatementForm
 
 
 def change_active(parent, request, queryset, target_state=True,
@@ -35,6 +42,64 @@ def change_active(parent, request, queryset, target_state=True,
         )
 
 
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that estimates the size of large unfiltered tables.
+
+    On PostgreSQL the planner statistics are used instead of a full
+    ``COUNT(*)`` once a table holds more than ``threshold`` rows.
+    """
+
+    threshold = 10000
+
+    @cached_property
+    def count(self):
+        """Estimated number of objects."""
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples FROM pg_class WHERE relname = %s",
+                    [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] > self.threshold:
+                return int(row[0])
+        return super().count
+
+
+class ActivePerformanceFilter(SimpleListFilter):
+    """Filter on one of the performances of the active productions."""
+
+    title = _('performance')
+    parameter_name = 'performance'
+    field = 'performance'
+
+    def lookups(self, request, model_admin):
+        """
+        Performances of the active productions are listed.
+
+        Sold out performances (no longer ``active``) are kept, those are
+        the ones to reconcile and audit.
+        """
+        return [(performance.id, str(performance))
+                for performance in Performance.objects.filter(
+                    production__active=True).select_related(
+                    'production', 'location').order_by('date')]
+
+    def queryset(self, request, queryset):
+        """Filter the orders."""
+        if self.value():
+            return queryset.filter(**{self.field + '_id': self.value()})
+        return queryset
+
+
+class TicketPerformanceFilter(ActivePerformanceFilter):
+    """Filter tickets on one of the performances of active productions."""
+
+    field = 'order__performance'
+
+
 @admin.register(Location)
 class LocationAdmin(ModelAdmin):
     """Location."""
@@ -83,7 +148,10 @@ class ProductionAdmin(ModelAdmin):
 class PerformanceAdmin(ModelAdmin):
     """A performance."""
 
-    list_display = ('production', 'date', 'location', 'seats', 'active')
+    list_display = ('production', 'date', 'location', 'seats',
+                    'tickets_sold', 'seats_held', 'active')
+    list_select_related = ('production', 'location')
+    search_fields = ('production__name',)
 
     def make_active(self, request, queryset):
         """Make active."""
@@ -99,6 +167,21 @@ class PerformanceAdmin(ModelAdmin):
     make_inactive.short_description = _("Make inactive")
 
 
+@admin.register(SeatHold)
+class SeatHoldAdmin(ModelAdmin):
+    """Seats held during checkout."""
+
+    list_display = ('performance', 'seats', 'created', 'expires')
+    list_select_related = ('performance__production',
+                           'performance__location')
+    list_filter = (ActivePerformanceFilter,)
+    readonly_fields = ('performance', 'seats', 'token', 'created', 'expires')
+
+    def has_add_permission(self, request):
+        """Holds are only made by buyers."""
+        return False
+
+
 class TicketInline(admin.TabularInline):
     """An inline ticket."""
 
@@ -112,12 +195,84 @@ class OnlineOrderAdmin(ModelAdmin, ExportCsvMixin):
 
     list_display = ('id', 'last_name', 'first_name', 'performance',
                     'num_tickets', 'total_price', 'payed', 'set_payed')
+    list_select_related = ('performance__production', 'performance__location')
     search_fields = ('last_name', 'first_name', 'email')
-    list_filter = ('performance', 'payed', 'performance__active')
+    list_filter = (ActivePerformanceFilter, 'payed', 'performance__active')
+    autocomplete_fields = ('performance',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     inlines = [
         TicketInline,
     ]
-    actions = ['export_as_csv']
+    actions = ['export_as_csv', 'mark_payed_and_send']
+
+    def num_tickets(self, obj):
+        """Stored number of tickets."""
+        return obj.ticket_count
+
+    def total_price(self, obj):
+        """Stored total price."""
+        return obj.total_amount
+
+    num_tickets.short_description = _("tickets")
+    num_tickets.admin_order_field = 'ticket_count'
+    total_price.short_description = _("total price")
+    total_price.admin_order_field = 'total_amount'
+
+    def get_urls(self):
+        """Add the bank statement import."""
+        return [
+            path('import-statement/',
+                 self.admin_site.admin_view(self.import_statement),
+                 name='orchestra_season_onlineorder_import_statement'),
+        ] + super().get_urls()
+
+    def import_statement(self, request):
+        """Mark the orders payed by the transfers of a bank statement."""
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+
+        form = BankStatementForm(request.POST or None, request.FILES or None)
+        result = payed = None
+        if form.is_valid():
+            try:
+                result, payed = import_statement(
+                    form.cleaned_data['statement'].read(),
+                    form.cleaned_data['format'],
+                    form.cleaned_data['dry_run'])
+            except ValueError as e:
+                form.add_error('statement', str(e))
+            else:
+                if not form.cleaned_data['dry_run']:
+                    self.message_user(request, _(
+                        "{payed} orders marked as payed.").format(
+                        payed=payed))
+
+        return TemplateResponse(
+            request, 'ticketing/admin/bank_statement.html', dict(
+                self.admin_site.each_context(request),
+                opts=self.model._meta,
+                title=_("Import bank statement"),
+                form=form,
+                result=result,
+                report=list(report_lines(result)) if result else [],
+                payed=payed,
+            ))
+
+    def mark_payed_and_send(self, request, queryset):
+        """Mark the orders as payed and queue their tickets."""
+        selected = list(queryset.values_list('id', flat=True))
+        payed = mark_payed(selected)
+        self.message_user(request, format_html(
+            _("{payed} orders marked as payed, their tickets are sent by "
+              "the <a href='{outbox}'>outbox</a>. {skipped} orders were "
+              "already payed."),
+            payed=payed, skipped=len(selected) - payed,
+            outbox=reverse('admin:orchestra_season_outgoingmail_changelist')
+            + '?attach_tickets__exact=1&sent__isnull=True'))
+
+    mark_payed_and_send.short_description = _(
+        "Mark as payed and send tickets")
 
     def set_payed(self, obj):
         return format_html(
@@ -131,6 +286,42 @@ class TicketAdmin(ModelAdmin):
     """Tickets."""
 
     list_display = ('id', 'price_category', 'used')
-    list_filter = ('order__performance', 'used')
-
-
+    list_select_related = ('price_category',)
+    list_filter = (TicketPerformanceFilter, 'used')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(OutgoingMail)
+class OutgoingMailAdmin(ModelAdmin):
+    """Mails in the outbox."""
+
+    list_display = ('subject', 'to', 'created', 'sent', 'attempts',
+                    'last_error')
+    list_filter = ('sent', 'attempts', 'attach_tickets')
+    search_fields = ('to', 'subject')
+    readonly_fields = ('order', 'attempts', 'sent', 'last_error',
+                       'attach_tickets')
+    exclude = ('attachment',)
+
+
+@admin.register(ScanEvent)
+class ScanEventAdmin(ModelAdmin):
+    """Scans at the door."""
+
+    list_display = ('scanned_at', 'gate', 'status', 'ticket_id',
+                    'performance')
+    list_select_related = ('performance__production',
+                           'performance__location')
+    list_filter = (ActivePerformanceFilter, 'gate', 'status')
+    raw_id_fields = ('ticket',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        """Scans are only recorded by the scanners."""
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        """The log is append-only."""
+        return False
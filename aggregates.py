@@ -0,0 +1,89 @@
+"""
+Sales aggregates for the stats.
+
+The number of orders and tickets is kept in one row per performance, hour
+and seller. Rows are updated incrementally when orders and tickets are
+created, moved or deleted, ``rebuild_sales_aggregates`` recomputes them
+all.
+"""
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+from django.db.models.functions import TruncHour
+from django.utils.timezone import localtime
+from .models import Order, SalesAggregate
+
+
+def bucket_of(date):
+    """Start of the hour of a date."""
+    return localtime(date).replace(minute=0, second=0, microsecond=0)
+
+
+def _sale_key(performance_id: int, date, seller_id: int = None):
+    return {'performance_id': performance_id, 'bucket': bucket_of(date),
+            'seller_id': seller_id}
+
+
+def _add_sales(key: dict, orders: int, tickets: int):
+    changes = {'orders': F('orders') + orders,
+               'tickets': F('tickets') + tickets}
+    if SalesAggregate.objects.filter(**key).update(**changes):
+        return
+    # Removals never create rows, the performance might be deleted as well
+    if orders < 0 or tickets < 0:
+        return
+    try:
+        with transaction.atomic():
+            SalesAggregate.objects.create(orders=orders, tickets=tickets,
+                                          **key)
+    except IntegrityError:
+        # Created by a concurrent sale since the update
+        SalesAggregate.objects.filter(**key).update(**changes)
+
+
+def record_sale(order: Order, orders: int = 0, tickets: int = 0):
+    """Add (or with negative numbers remove) sales of an order."""
+    _add_sales(_sale_key(order.performance_id, order.date, order.seller_id),
+               orders, tickets)
+
+
+def move_sale(counted: dict, order: Order, tickets: int):
+    """
+    Move the sales of an edited order.
+
+    ``counted`` has the ``performance_id``, ``date`` and ``seller_id`` the
+    order was counted with, nothing changes when it stays in the same row.
+    """
+    before = _sale_key(counted['performance_id'], counted['date'],
+                       counted['seller_id'])
+    after = _sale_key(order.performance_id, order.date, order.seller_id)
+    if before != after:
+        _add_sales(before, -1, -tickets)
+        _add_sales(after, 1, tickets)
+
+
+def remove_seller(seller_id: int):
+    """Count the sales of a seller who is deleted as sales without one."""
+    with transaction.atomic():
+        for aggregate in SalesAggregate.objects.filter(seller_id=seller_id):
+            aggregate.delete()
+            _add_sales(_sale_key(aggregate.performance_id, aggregate.bucket),
+                       aggregate.orders, aggregate.tickets)
+
+
+def rebuild_aggregates():
+    """Recompute all aggregates from the orders."""
+    rows = Order.objects.annotate(bucket=TruncHour('date')).values(
+        'performance_id', 'bucket', 'seller_id').annotate(
+        num_orders=Count('id', distinct=True), num_tickets=Count('tickets'),
+    ).order_by()
+    with transaction.atomic():
+        SalesAggregate.objects.all().delete()
+        SalesAggregate.objects.bulk_create([
+            SalesAggregate(
+                performance_id=row['performance_id'], bucket=row['bucket'],
+                seller_id=row['seller_id'], orders=row['num_orders'],
+                tickets=row['num_tickets'])
+            for row in rows.iterator()
+        ], batch_size=1000)
+    return SalesAggregate.objects.count()
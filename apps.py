@@ -1,5 +1,25 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core import checks
+
+
+def check_qr_key(app_configs, **kwargs):
+    """Warn when the QR codes are signed with the SECRET_KEY."""
+    if getattr(settings, 'TICKETING_QR_KEY', None):
+        return []
+    return [checks.Warning(
+        "TICKETING_QR_KEY is not set, the QR codes of the tickets are "
+        "signed with the SECRET_KEY.",
+        hint="Set TICKETING_QR_KEY to a separate secret, rotating the "
+             "SECRET_KEY would revoke every printed ticket.",
+        id='orchestra_season.W001',
+    )]
 
 
 class OrchestraSeasonConfig(AppConfig):
     name = 'orchestra_season'
+
+    def ready(self):
+        """Connect the signal handlers and register the checks."""
+        from . import signals  # noqa: F401
+        checks.register(check_qr_key)
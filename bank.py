@@ -0,0 +1,287 @@
+"""
+Bank statement reconciliation.
+
+Buyers paying by transfer use ``OnlineOrder.payment_message`` ("Tickets
+<last name> - <order id>") as reference. ``read_statement`` extracts the
+credit transfers of a CSV or CODA export, ``reconcile`` matches them to
+the orders in one query and ``mark_payed`` marks the matching orders payed
+and queues their tickets.
+"""
+
+import csv
+import io
+import re
+from collections import defaultdict
+from datetime import datetime
+from typing import NamedTuple
+from django.db import transaction
+from .models import OnlineOrder
+from .outbox import queue_tickets_mails
+
+FORMATS = ('csv', 'coda')
+
+REFERENCE = re.compile(r'tickets\s.*?-\s*(\d+)', re.IGNORECASE | re.DOTALL)
+
+# Header names of the columns in CSV exports of the banks we use
+AMOUNT_COLUMNS = ('amount', 'bedrag', 'montant', 'betrag')
+DATE_COLUMNS = ('date', 'datum', 'boekingsdatum', 'uitvoeringsdatum',
+                'valutadatum', 'date valeur')
+NAME_COLUMNS = ('name', 'naam', 'naam tegenpartij', 'tegenpartij',
+                'counterparty', 'nom de la contrepartie')
+DESCRIPTION_COLUMNS = ('mededeling', 'omschrijving', 'description',
+                       'communication', 'communication libre', 'message',
+                       'reference', 'referentie', 'verwendungszweck')
+
+# Rounding margin when comparing amounts
+TOLERANCE = 0.005
+
+
+class Transfer(NamedTuple):
+    """An incoming transfer on a statement."""
+
+    line: int
+    date: str
+    amount: float
+    name: str
+    reference: str
+
+    @property
+    def order_id(self):
+        """Order id in the reference, None without a ticket reference."""
+        match = REFERENCE.search(self.reference)
+        return int(match.group(1)) if match else None
+
+
+class Reconciliation(NamedTuple):
+    """Outcome of matching a statement with the orders."""
+
+    # Order ids to mark payed
+    payed: list
+    # (order id, transfers) of orders that were payed before
+    already_payed: list
+    # (order id, expected amount, transfers) of wrong amounts
+    mismatched: list
+    # (order id, transfers) without an online order
+    unknown: list
+    # Transfers without a ticket reference
+    unmatched: list
+
+
+def _decode(data: bytes):
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return data.decode('cp1252')
+
+
+def parse_amount(value: str):
+    """Amount of a CSV cell, both '1.234,56' and '1,234.56' are read."""
+    value = re.sub(r'[^\d,.\-+]', '', value)
+    if ',' in value and value.rfind(',') > value.rfind('.'):
+        value = value.replace('.', '').replace(',', '.')
+    else:
+        value = value.replace(',', '')
+    return float(value)
+
+
+def _column(header, names):
+    for i, title in enumerate(header):
+        if title.strip().lower() in names:
+            return i
+    return None
+
+
+def _columns(header, names):
+    """All columns with one of the names, also when numbered."""
+    return [i for i, title in enumerate(header)
+            if title.strip().lower().rstrip('0123456789 ') in names]
+
+
+def _cell(row, column):
+    """Value in a column, empty when the row is too short."""
+    if column is None or column >= len(row):
+        return ''
+    return row[column]
+
+
+def _delimiter(text: str):
+    """
+    Delimiter of a CSV export, the most frequent one in the header.
+
+    The header names hold no delimiters, unlike the data (amounts with a
+    decimal comma, ragged rows) that misleads ``csv.Sniffer``.
+    """
+    header = text.split('\n', 1)[0]
+    return max(';,\t', key=header.count)
+
+
+def read_csv(data: bytes):
+    """
+    Credit transfers of a CSV export.
+
+    The reference is read from the communication columns, or from every
+    column that is not an amount, date or name when there are none.
+    """
+    text = _decode(data)
+    rows = csv.reader(io.StringIO(text), delimiter=_delimiter(text))
+    header = next(rows, [])
+    amount = _column(header, AMOUNT_COLUMNS)
+    if amount is None:
+        raise ValueError("No amount column in the statement.")
+    date = _column(header, DATE_COLUMNS)
+    name = _column(header, NAME_COLUMNS)
+    descriptions = _columns(header, DESCRIPTION_COLUMNS)
+    if not descriptions:
+        # Any column that is not known to hold something else
+        known = AMOUNT_COLUMNS + DATE_COLUMNS + NAME_COLUMNS
+        descriptions = [i for i, title in enumerate(header)
+                        if title.strip().lower() not in known]
+
+    for line, row in enumerate(rows, start=2):
+        if not _cell(row, amount).strip():
+            continue
+        value = parse_amount(row[amount])
+        if value <= 0:
+            continue
+        yield Transfer(
+            line=line,
+            date=_cell(row, date),
+            amount=value,
+            name=_cell(row, name),
+            # Banks split the communication over several columns, cells
+            # past the header are a communication holding the delimiter
+            reference=' '.join([_cell(row, i) for i in descriptions]
+                               + row[len(header):]),
+        )
+
+
+def read_coda(data: bytes):
+    """
+    Credit transfers of a CODA statement (Belgian banking standard).
+
+    Movements are read from the records 2.1 (amount and communication),
+    2.2 (communication) and 2.3 (counterparty and communication). The
+    details of a globalised movement are read instead of its total.
+    """
+    transfers = []
+    globalised = {}
+    movement = None
+    for line, record in enumerate(_decode(data).splitlines(), start=1):
+        record = record.ljust(128)
+        kind = record[:2]
+        if kind == '21':
+            sequence, detail = record[2:6], record[6:10]
+            if detail != '0000' and sequence in globalised:
+                # The details replace the globalised movement
+                globalised.pop(sequence)['skip'] = True
+            movement = {
+                'line': line,
+                'skip': record[31] != '0',  # debit
+                'amount': int(record[32:47] or 0) / 1000,
+                'date': datetime.strptime(
+                    record[47:53], '%d%m%y').date().isoformat()
+                if record[47:53].strip('0 ') else '',
+                'name': '',
+                'reference': [record[62:115]],
+            }
+            if detail == '0000':
+                globalised[sequence] = movement
+            transfers.append(movement)
+        elif kind == '22' and movement:
+            movement['reference'].append(record[10:63])
+        elif kind == '23' and movement:
+            movement['name'] = record[47:82].strip()
+            movement['reference'].append(record[82:125])
+
+    for movement in transfers:
+        if not movement['skip'] and movement['amount'] > 0:
+            yield Transfer(
+                line=movement['line'], date=movement['date'],
+                amount=movement['amount'], name=movement['name'],
+                reference=' '.join(' '.join(movement['reference']).split()))
+
+
+def read_statement(data: bytes, format: str = 'csv'):
+    """Credit transfers of a statement."""
+    if format == 'coda':
+        return list(read_coda(data))
+    return list(read_csv(data))
+
+
+def reconcile(transfers):
+    """Match transfers with the online orders, in a single query."""
+    by_order = defaultdict(list)
+    unmatched = []
+    for transfer in transfers:
+        order_id = transfer.order_id
+        if order_id is None:
+            unmatched.append(transfer)
+        else:
+            by_order[order_id].append(transfer)
+
+    orders = {order['id']: order for order in OnlineOrder.objects.filter(
+        id__in=by_order).values('id', 'payed', 'total_amount')}
+    result = Reconciliation([], [], [], [], unmatched)
+    for order_id, payments in sorted(by_order.items()):
+        order = orders.get(order_id)
+        if order is None:
+            result.unknown.append((order_id, payments))
+        elif abs(sum(payment.amount for payment in payments)
+                 - order['total_amount']) > TOLERANCE:
+            result.mismatched.append(
+                (order_id, order['total_amount'], payments))
+        elif order['payed']:
+            result.already_payed.append((order_id, payments))
+        else:
+            result.payed.append(order_id)
+    return result
+
+
+def mark_payed(order_ids):
+    """
+    Mark orders payed and queue their tickets.
+
+    Orders that are already payed are skipped, so a double import never
+    sends tickets twice. Returns the number of orders marked payed.
+    """
+    with transaction.atomic():
+        ids = list(OnlineOrder.objects.filter(
+            id__in=order_ids, payed=False).select_for_update().values_list(
+            'id', flat=True))
+        OnlineOrder.objects.filter(id__in=ids).update(payed=True)
+        queue_tickets_mails(OnlineOrder.objects.filter(
+            id__in=ids).select_related(
+            'performance__production', 'performance__location',
+        ).prefetch_related('tickets__price_category'))
+    return len(ids)
+
+
+def import_statement(data: bytes, format: str = 'csv',
+                     dry_run: bool = False):
+    """Reconcile a statement, returns the reconciliation and payed count."""
+    result = reconcile(read_statement(data, format))
+    payed = 0
+    if not dry_run and result.payed:
+        payed = mark_payed(result.payed)
+    return result, payed
+
+
+def report_lines(result: Reconciliation):
+    """Human readable mismatches of a reconciliation."""
+    def describe(transfers):
+        return ', '.join('line %d: %.2f %s' % (
+            transfer.line, transfer.amount, transfer.name)
+            for transfer in transfers)
+
+    for order_id, expected, transfers in result.mismatched:
+        yield "Order %d expects %.2f, got %s" % (
+            order_id, expected, describe(transfers))
+    for order_id, transfers in result.unknown:
+        yield "Order %d does not exist (%s)" % (order_id, describe(transfers))
+    for order_id, transfers in result.already_payed:
+        yield "Order %d was already payed (%s)" % (
+            order_id, describe(transfers))
+    for transfer in result.unmatched:
+        yield "No order in line %d: %.2f %s %s" % (
+            transfer.line, transfer.amount, transfer.name,
+            transfer.reference[:80])
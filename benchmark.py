@@ -0,0 +1,289 @@
+"""
+Synthetic ticketing data and view benchmarks.
+
+Everything is inserted with ``bulk_create`` in batches, benchmarks run in
+a transaction that is rolled back afterwards.
+"""
+
+import random
+import statistics
+import time
+from datetime import timedelta
+from itertools import cycle
+from secrets import token_urlsafe
+from django.contrib.auth import get_user_model
+from django.db import connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.timezone import now
+from .aggregates import rebuild_aggregates
+from .caching import invalidate_overview, invalidate_availability
+from .inventory import recount_seats
+from .models import Location, PriceCategory, Production, Performance, \
+    Order, OnlineOrder, Ticket, random_key, signed_code
+
+BATCH_SIZE = 5000
+
+# Maximum number of queries per request, a view using more fails the
+# benchmark. Update them deliberately when a view changes.
+QUERY_BUDGETS = {
+    'overview': 3,
+    'availability': 1,
+    # The performance with its production and location, price categories
+    'order (form)': 2,
+    # The form reads plus the replay lookup, the seat claim, the order (two
+    # tables), its sales row (created in a savepoint for the first sale of
+    # an hour), the tickets and the mail, in a transaction
+    'order (submit)': 14,
+    'stats': 5,
+    'csv_export': 7,
+    'qr_reply': 2,
+    'download_tickets': 6,
+}
+
+
+def _insert_online_orders(orders, using='default'):
+    """
+    Insert online orders in bulk.
+
+    ``bulk_create`` does not support multi-table inheritance, so the
+    orders are created first and the online order rows inserted after.
+    """
+    parents = [Order(**{field.attname: getattr(order, field.attname)
+                        for field in Order._meta.concrete_fields})
+               for order in orders]
+    Order.objects.using(using).bulk_create(parents)
+    if parents[0].pk is None:
+        # Backends that don't return the ids of inserted rows
+        ids = dict(Order.objects.using(using).filter(
+            hash__in=[order.hash for order in parents]).values_list(
+            'hash', 'id'))
+        for order in parents:
+            order.pk = ids[order.hash]
+    for order, parent in zip(orders, parents):
+        order.pk = order.order_ptr_id = parent.pk
+
+    connection = connections[using]
+    fields = OnlineOrder._meta.local_concrete_fields
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        connection.ops.quote_name(OnlineOrder._meta.db_table),
+        ', '.join(connection.ops.quote_name(field.column)
+                  for field in fields),
+        ', '.join(['%s'] * len(fields)))
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [
+            [field.get_db_prep_save(getattr(order, field.attname),
+                                    connection)
+             for field in fields]
+            for order in orders])
+
+
+def seed_orders(performance: Performance, count: int, tickets: int = 1,
+                online: bool = False, payed: bool = False):
+    """Insert ``count`` orders of ``tickets`` tickets for a performance."""
+    categories = cycle(performance.price_categories.all() or [None])
+    start = performance.open_sales
+    created = 0
+    while created < count:
+        orders = []
+        order_tickets = []
+        for i in range(min(BATCH_SIZE, count - created)):
+            data = {
+                'performance': performance, 'hash': token_urlsafe(50),
+                'date': start + timedelta(seconds=created + i),
+                'payed': payed,
+            }
+            if online:
+                order = OnlineOrder(
+                    first_name='Buyer', last_name='N%d' % (created + i),
+                    email='buyer%d@example.com' % (created + i), **data)
+            else:
+                order = Order(**data)
+            price_categories = [next(categories) for t in range(tickets)]
+            order.ticket_count = tickets
+            order.total_amount = sum(category.price for category in
+                                     price_categories if category)
+            orders.append(order)
+            order_tickets.append(price_categories)
+
+        if online:
+            _insert_online_orders(orders)
+        else:
+            Order.objects.bulk_create(orders)
+            if orders[0].pk is None:
+                ids = dict(Order.objects.filter(
+                    hash__in=[order.hash for order in orders]).values_list(
+                    'hash', 'id'))
+                for order in orders:
+                    order.pk = ids[order.hash]
+
+        Ticket.objects.bulk_create([
+            Ticket(order_id=order.pk, price_category=category,
+                   code=random_key())
+            for order, price_categories in zip(orders, order_tickets)
+            for category in price_categories
+        ], batch_size=BATCH_SIZE)
+        created += len(orders)
+    return created
+
+
+def seed_season(productions: int = 1, performances: int = 3,
+                categories: int = 3, orders: int = 1000, tickets: int = 2):
+    """
+    Create a synthetic season that is open for sales today.
+
+    Every performance gets ``orders`` online orders (half of them payed)
+    of ``tickets`` tickets. Returns the performances.
+    """
+    suffix = token_urlsafe(6)
+    location = Location.objects.create(
+        name='Benchmark %s' % suffix, address='Benchmark street 1')
+    price_categories = [
+        PriceCategory.objects.create(
+            name='Benchmark %s %d' % (suffix, i), price=5 + 5 * i)
+        for i in range(categories)]
+    season = []
+    for p in range(productions):
+        production = Production.objects.create(
+            name='Benchmark %s %d' % (suffix, p), description='Benchmark')
+        for i in range(performances):
+            performance = Performance.objects.create(
+                production=production, location=location,
+                date=now() + timedelta(minutes=i),
+                seats=orders * tickets * 2 + 1000,
+                open_sales=now() - timedelta(days=60),
+                close_sales=now() + timedelta(days=1),
+                close_transfer_sales=now() + timedelta(days=1))
+            performance.price_categories.set(price_categories)
+            seed_orders(performance, orders // 2, tickets, online=True)
+            seed_orders(performance, orders - orders // 2, tickets,
+                        online=True, payed=True)
+            recount_seats(performance)
+            season.append(performance)
+    rebuild_aggregates()
+    invalidate_overview()
+    return season
+
+
+def timed(function, repeat: int):
+    """Median duration of a function in milliseconds."""
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(i)
+        durations.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations)
+
+
+def percentile(durations, p):
+    """The p-th percentile of a list of durations."""
+    durations = sorted(durations)
+    return durations[min(len(durations) - 1, int(len(durations) * p / 100))]
+
+
+class ViewBenchmark:
+    """Drive all ticketing views through the test client."""
+
+    def __init__(self, season):
+        """Prepare a staff client and some orders and tickets to use."""
+        self.season = season
+        self.performance = season[0]
+        self.categories = list(self.performance.price_categories.all())
+        user, created = get_user_model().objects.get_or_create(
+            username='benchmark', defaults={
+                'is_staff': True, 'is_superuser': True})
+        self.client = Client()
+        self.client.force_login(user)
+        self.anonymous = Client()
+        self.payed = list(OnlineOrder.objects.filter(
+            performance=self.performance, payed=True).values_list(
+            'id', 'hash')[:100])
+        self.tickets = list(Ticket.objects.filter(
+            order__performance=self.performance).values_list(
+            'id', 'code')[:1000])
+
+    def overview(self, i):
+        """The public overview, without cache."""
+        invalidate_overview()
+        return self.anonymous.get(reverse('tickets:overview'))
+
+    def availability(self, i):
+        """The availability polled by the front end, without cache."""
+        invalidate_availability()
+        return self.anonymous.get(reverse('tickets:availability'))
+
+    def order_form(self, i):
+        """Open the order form."""
+        return self.anonymous.get(
+            reverse('tickets:order', kwargs={'id': self.performance.id}))
+
+    def order_submit(self, i):
+        """Place an order."""
+        data = {
+            'first_name': 'Bench', 'last_name': 'Mark',
+            'email': 'benchmark@example.com', 'payment_method': 'transfer',
+            'first_concert': 'True', 'hash': token_urlsafe(50),
+        }
+        for category in self.categories:
+            data[category.name] = 1
+        return self.anonymous.post(
+            reverse('tickets:order', kwargs={'id': self.performance.id}),
+            data)
+
+    def stats(self, i):
+        """The sales dashboard."""
+        return self.client.get(reverse('tickets:stats'))
+
+    def csv_export(self, i):
+        """The CSV export of a performance."""
+        return self.client.get(
+            reverse('tickets:csv', kwargs={'id': self.performance.id}))
+
+    def qr_reply(self, i):
+        """Scan a ticket."""
+        id, code = random.choice(self.tickets)
+        return self.anonymous.post(reverse('tickets:qr_reply'), {
+            'code': 'https://example.com' + reverse(
+                'tickets:qr_info', kwargs={
+                    'id': id,
+                    'code': signed_code(id, self.performance.id, code)}),
+            'performance': self.performance.id,
+        })
+
+    def download_tickets(self, i):
+        """Download the (stored) tickets of an order."""
+        id, code = self.payed[i % len(self.payed)]
+        return self.anonymous.get(reverse(
+            'tickets:order_download', kwargs={'id': id, 'code': code}))
+
+    def views(self):
+        """Name and driver of every benchmarked view."""
+        return [
+            ('overview', self.overview),
+            ('availability', self.availability),
+            ('order (form)', self.order_form),
+            ('order (submit)', self.order_submit),
+            ('stats', self.stats),
+            ('csv_export', self.csv_export),
+            ('qr_reply', self.qr_reply),
+            ('download_tickets', self.download_tickets),
+        ]
+
+    def run(self, view, repeat: int):
+        """Latencies (ms) and maximum query count of a view."""
+        durations = []
+        queries = 0
+        for i in range(repeat):
+            with CaptureQueriesContext(connections['default']) as context:
+                start = time.perf_counter()
+                response = view(i)
+                if response.streaming:
+                    for chunk in response.streaming_content:
+                        pass
+                durations.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                raise RuntimeError("%s answered %d" % (
+                    view.__name__, response.status_code))
+            queries = max(queries, len(context))
+        return durations, queries
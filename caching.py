@@ -0,0 +1,99 @@
+"""
+Cached data of the public pages.
+
+Entries are invalidated by the signal handlers when the underlying models
+change, use a cache backend shared by all workers in production.
+
+The availability of the performances is polled by the front end, it is
+kept for a few seconds only and updated in place when seats are sold.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Prefetch
+from django.utils import timezone
+from .models import Production, Performance
+
+OVERVIEW_KEY = 'tickets:overview'
+AVAILABILITY_KEY = 'tickets:availability'
+
+
+def overview_data():
+    """Active productions with their performances, in three queries."""
+    data = cache.get(OVERVIEW_KEY)
+    if data is None:
+        performances = Performance.objects.select_related(
+            'production', 'location').prefetch_related(
+            'price_categories').order_by('date')
+        data = [{
+            "production": production,
+            "performances": list(production.performances.all()),
+        } for production in Production.objects.filter(
+            active=True).prefetch_related(
+            Prefetch('performances', queryset=performances))]
+        cache.set(OVERVIEW_KEY, data, getattr(
+            settings, 'TICKETING_OVERVIEW_CACHE_TIMEOUT', 3600))
+    return data
+
+
+def invalidate_overview():
+    """Drop the cached overview."""
+    cache.delete(OVERVIEW_KEY)
+
+
+def availability_ttl():
+    """Seconds the availability is cached."""
+    return getattr(settings, 'TICKETING_AVAILABILITY_TTL', 10)
+
+
+def _availability():
+    """Remaining seats of the active performances, by id."""
+    data = cache.get(AVAILABILITY_KEY)
+    if data is None:
+        data = {
+            performance['id']: performance
+            for performance in Performance.objects.filter(
+                active=True, production__active=True).values(
+                'id', 'production_id', 'date', 'seats', 'tickets_sold',
+                'seats_held', 'open_sales', 'close_sales')
+        }
+        cache.set(AVAILABILITY_KEY, data, availability_ttl())
+    return data
+
+
+def availability_data():
+    """Remaining seats and sales state of the active performances."""
+    current = timezone.now()
+    data = []
+    for performance in sorted(_availability().values(),
+                              key=lambda performance: performance['date']):
+        remaining = max(performance['seats'] - performance['tickets_sold']
+                        - performance['seats_held'], 0)
+        data.append({
+            'id': performance['id'],
+            'production': performance['production_id'],
+            'date': performance['date'],
+            'remaining': remaining,
+            'open': (performance['open_sales'] <= current
+                     <= performance['close_sales'] and remaining > 0),
+        })
+    return data
+
+
+def sold_seats(performance_id: int, sold: int, held: int = 0):
+    """
+    Write sold and held seats through to the cached availability.
+
+    Concurrent sales may overwrite each other here, the short timeout
+    bounds how long such a difference is served.
+    """
+    data = cache.get(AVAILABILITY_KEY)
+    if data is not None and performance_id in data:
+        data[performance_id]['tickets_sold'] += sold
+        data[performance_id]['seats_held'] += held
+        cache.set(AVAILABILITY_KEY, data, availability_ttl())
+
+
+def invalidate_availability():
+    """Drop the cached availability."""
+    cache.delete(AVAILABILITY_KEY)
@@ -0,0 +1,180 @@
+"""
+Bulk export of orders and tickets.
+
+Exports stream one row per ticket (with the data of its order) for a
+production and/or a range of performance dates. Orders are read in
+batches with keyset pagination over ``Order.id``, so memory stays flat
+for whole seasons.
+
+A format is a small ``Exporter`` subclass registered with
+``register_exporter``; it turns the rows into chunks of bytes.
+"""
+
+import csv
+import json
+from importlib.util import find_spec
+from tempfile import SpooledTemporaryFile
+from django.utils.dateparse import parse_date
+from .models import Order, Ticket
+
+COLUMNS = [
+    'order', 'order_date', 'production', 'performance', 'first_name',
+    'last_name', 'email', 'payment_method', 'payed', 'seller', 'ticket',
+    'price_category', 'price', 'used',
+]
+BATCH_SIZE = 2000
+
+EXPORTERS = {}
+
+
+class Echo:
+    """File-like object handing back what is written, to stream a CSV."""
+
+    def write(self, value):
+        """Return the value instead of storing it."""
+        return value
+
+
+def register_exporter(exporter):
+    """Make an export format available (class decorator)."""
+    EXPORTERS[exporter.name] = exporter
+    return exporter
+
+
+def parse_bound(value: str):
+    """
+    Date of a range bound (YYYY-MM-DD), None when empty.
+
+    Raises ValueError for anything else, a typo must not export every
+    order.
+    """
+    if not value:
+        return None
+    date = parse_date(value)
+    if date is None:
+        raise ValueError("Invalid date %r, use YYYY-MM-DD." % value)
+    return date
+
+
+def select_orders(production=None, start=None, end=None):
+    """Orders of a production and/or of performances between two dates."""
+    orders = Order.objects.all()
+    if production is not None:
+        orders = orders.filter(performance__production=production)
+    if start is not None:
+        orders = orders.filter(performance__date__date__gte=start)
+    if end is not None:
+        orders = orders.filter(performance__date__date__lte=end)
+    return orders
+
+
+def export_rows(orders, batch_size: int = BATCH_SIZE):
+    """Yield a row (as a list following COLUMNS) for every ticket."""
+    orders = orders.select_related(
+        'performance__production', 'performance__location', 'seller',
+        'onlineorder').order_by('id')
+    last_id = 0
+    while True:
+        batch = list(orders.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return
+        last_id = batch[-1].id
+
+        tickets = {}
+        for ticket in Ticket.objects.filter(
+                order_id__in=[order.id for order in batch]).select_related(
+                'price_category').order_by('id'):
+            tickets.setdefault(ticket.order_id, []).append(ticket)
+
+        for order in batch:
+            online_order = getattr(order, 'onlineorder', None)
+            order_data = [
+                order.id, order.date.isoformat(),
+                order.performance.production.name, str(order.performance),
+                getattr(online_order, 'first_name', ''),
+                getattr(online_order, 'last_name', ''),
+                getattr(online_order, 'email', ''),
+                getattr(online_order, 'payment_method', ''),
+                order.payed, str(order.seller or ''),
+            ]
+            for ticket in tickets.get(order.id, []):
+                yield order_data + [
+                    ticket.id, ticket.price_category.name,
+                    ticket.price_category.price, ticket.used,
+                ]
+
+
+class Exporter:
+    """Base class of an export format."""
+
+    name = None
+    content_type = 'application/octet-stream'
+    extension = None
+
+    @classmethod
+    def available(cls):
+        """Whether the dependencies of the format are installed."""
+        return True
+
+    def stream(self, rows):
+        """Yield the export in chunks."""
+        raise NotImplementedError
+
+
+@register_exporter
+class CsvExporter(Exporter):
+    """Semicolon separated values, like the performance export."""
+
+    name = 'csv'
+    content_type = 'text/csv'
+    extension = 'csv'
+
+    def stream(self, rows):
+        """Yield a line per row."""
+        writer = csv.writer(Echo(), delimiter=';')
+        yield writer.writerow(COLUMNS).encode()
+        for row in rows:
+            yield writer.writerow(row).encode()
+
+
+@register_exporter
+class NdjsonExporter(Exporter):
+    """One JSON object per line."""
+
+    name = 'ndjson'
+    content_type = 'application/x-ndjson'
+    extension = 'ndjson'
+
+    def stream(self, rows):
+        """Yield a line per row."""
+        for row in rows:
+            yield (json.dumps(dict(zip(COLUMNS, row))) + '\n').encode()
+
+
+@register_exporter
+class XlsxExporter(Exporter):
+    """Excel workbook, requires openpyxl."""
+
+    name = 'xlsx'
+    content_type = ('application/vnd.openxmlformats-officedocument.'
+                    'spreadsheetml.sheet')
+    extension = 'xlsx'
+
+    @classmethod
+    def available(cls):
+        """Whether openpyxl is installed."""
+        return find_spec('openpyxl') is not None
+
+    def stream(self, rows):
+        """Build the workbook in a temporary file and yield it."""
+        from openpyxl import Workbook
+
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet('orders')
+        sheet.append(COLUMNS)
+        for row in rows:
+            sheet.append(row)
+        with SpooledTemporaryFile(max_size=10 * 1024 * 1024) as f:
+            workbook.save(f)
+            f.seek(0)
+            yield from iter(lambda: f.read(65536), b'')
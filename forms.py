@@ -1,6 +1,7 @@
 """Forms for orchestra seasons."""
 
-from django.forms import ModelForm, Form, IntegerField, HiddenInput
+from django.forms import ModelForm, Form, IntegerField, HiddenInput, \
+    FileField, ChoiceField, BooleanField
 from django.utils.translation import gettext_lazy as _
 from django.utils.timezone import now
 from django.conf import settings
@@ -100,6 +101,9 @@ class OnlineOrderForm(ModelForm):
                 "How do you want to pay?"
             )
 
+    def validate_unique(self):
+        """Skip the unique hash check, the view handles reposts."""
+
     class Meta:
         """Meta data."""
 
@@ -108,3 +112,15 @@ class OnlineOrderForm(ModelForm):
         fields = ('first_name', 'last_name', 'email',
                   'first_concert', 'payment_method',
                   'marketing_feedback', 'remarks', 'hash')
+
+
+class BankStatementForm(Form):
+    """Upload of a bank statement."""
+
+    statement = FileField(label=_("Bank statement"))
+    format = ChoiceField(label=_("Format"), choices=(
+        ('csv', _("CSV export")),
+        ('coda', _("CODA")),
+    ))
+    dry_run = BooleanField(label=_("Only report, change nothing"),
+                           required=False)
@@ -0,0 +1,163 @@
+"""
+Seat inventory of performances.
+
+Every performance keeps a counter of the tickets it sold and of the seats
+held for buyers filling in the order form. The counters are changed with
+conditional updates inside the transaction that creates the tickets or
+holds, so two concurrent buyers can never oversell a performance:
+``tickets_sold + seats_held`` never exceeds ``seats``.
+
+Holds expire after ``TICKETING_SEAT_HOLD_TTL`` seconds, their seats are
+released in bulk by ``expire_holds`` (the ``expire_seat_holds`` command).
+"""
+
+from collections import defaultdict
+from datetime import timedelta
+from secrets import token_urlsafe
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils.timezone import now
+from .caching import invalidate_overview, invalidate_availability, \
+    sold_seats
+from .models import Performance, SeatHold, Ticket
+
+
+class SoldOut(Exception):
+    """Not enough seats left for an order."""
+
+
+def hold_ttl():
+    """Time a buyer keeps their seats while ordering."""
+    return timedelta(seconds=getattr(settings, 'TICKETING_SEAT_HOLD_TTL',
+                                     600))
+
+
+def _take_hold(performance: Performance, token: str):
+    """Remove a hold of a performance, returns it (None without one)."""
+    if not token:
+        return None
+    hold = SeatHold.objects.select_for_update().filter(
+        performance=performance, token=token).first()
+    if hold is not None:
+        hold.delete()
+    return hold
+
+
+def _claim(performance: Performance, sold: int = 0, held: int = 0,
+           released: int = 0):
+    """
+    Change the counters of a performance if the seats are there.
+
+    Returns whether the last seats were sold, the same update then closes
+    the sales.
+    """
+    seats = Performance.objects.filter(
+        id=performance.id, active=True,
+        tickets_sold__lte=F('seats') - F('seats_held') + released
+        - sold - held,
+    )
+    changes = {'tickets_sold': F('tickets_sold') + sold,
+               'seats_held': F('seats_held') + held - released}
+    if not sold:
+        if seats.update(**changes):
+            return False
+        raise SoldOut(performance)
+
+    last_seats = Q(tickets_sold__gte=F('seats') - sold)
+    if seats.exclude(last_seats).update(**changes):
+        return False
+    if seats.filter(last_seats).update(active=False, **changes):
+        return True
+    raise SoldOut(performance)
+
+
+def hold_seats(performance: Performance, amount: int, token: str = None):
+    """
+    Hold seats for a buyer, replacing their previous hold.
+
+    Returns the new hold, its token is passed to ``reserve_seats`` when
+    the order is placed.
+    """
+    with transaction.atomic():
+        previous = _take_hold(performance, token)
+        released = previous.seats if previous else 0
+        _claim(performance, held=amount, released=released)
+        # Only the token of a hold of this performance is reused
+        hold = SeatHold.objects.create(
+            performance=performance, seats=amount,
+            token=previous.token if previous else token_urlsafe(32),
+            expires=now() + hold_ttl())
+        transaction.on_commit(
+            lambda: sold_seats(performance.id, 0, amount - released))
+    return hold
+
+
+def reserve_seats(performance: Performance, amount: int, hold: str = None):
+    """
+    Claim seats for a new order, converting the hold of the buyer.
+
+    Must be called inside the transaction that creates the tickets: the
+    update locks the performance row until the order is committed.
+    """
+    hold = _take_hold(performance, hold)
+    released = hold.seats if hold else 0
+    if _claim(performance, sold=amount, released=released):
+        transaction.on_commit(invalidate_overview)
+        transaction.on_commit(invalidate_availability)
+    else:
+        transaction.on_commit(
+            lambda: sold_seats(performance.id, amount, -released))
+
+
+def expire_holds(batch_size: int = 1000):
+    """Release the seats of expired holds, returns the number of holds."""
+    expired = 0
+    while True:
+        with transaction.atomic():
+            holds = SeatHold.objects.filter(expires__lte=now())
+            if connection.features.has_select_for_update_skip_locked:
+                holds = holds.select_for_update(skip_locked=True)
+            holds = list(holds.values_list(
+                'id', 'performance_id', 'seats')[:batch_size])
+            if not holds:
+                break
+
+            SeatHold.objects.filter(
+                id__in=[id for id, performance, seats in holds]).delete()
+            released = defaultdict(int)
+            for id, performance, seats in holds:
+                released[performance] += seats
+            for performance, seats in released.items():
+                Performance.objects.filter(id=performance).update(
+                    seats_held=F('seats_held') - seats)
+        expired += len(holds)
+
+    if expired:
+        invalidate_availability()
+    return expired
+
+
+def adjust_sold(order_id: int, delta: int):
+    """Shift the counter for tickets added or removed outside an order."""
+    Performance.objects.filter(orders__id=order_id).update(
+        tickets_sold=F('tickets_sold') + delta)
+    invalidate_availability()
+
+
+def move_sold(from_performance: int, to_performance: int, amount: int):
+    """Move the sold seats of an order that changed performance."""
+    Performance.objects.filter(id=from_performance).update(
+        tickets_sold=F('tickets_sold') - amount)
+    Performance.objects.filter(id=to_performance).update(
+        tickets_sold=F('tickets_sold') + amount)
+    invalidate_availability()
+
+
+def recount_seats(performance: Performance):
+    """Recount the sold tickets of a performance from scratch."""
+    sold = Ticket.objects.filter(order__performance=performance).count()
+    Performance.objects.filter(id=performance.id).update(tickets_sold=sold)
+    invalidate_availability()
+    performance.tickets_sold = sold
+    return sold
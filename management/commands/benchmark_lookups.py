@@ -0,0 +1,53 @@
+"""Benchmark the hot ticketing lookups against growing order tables."""
+
+import random
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from ...benchmark import seed_orders, timed
+from ...models import Order, Performance, Ticket
+
+
+class Command(BaseCommand):
+    """Time the order hash, ticket code and performance lookups."""
+
+    help = ("Seed synthetic orders (rolled back afterwards) and time the "
+            "lookups used by ordering, scanning and exports.")
+
+    def add_arguments(self, parser):
+        """Add arguments."""
+        parser.add_argument('--performance', type=int, required=True,
+                            help="Performance to attach the orders to.")
+        parser.add_argument('--sizes', type=int, nargs='+',
+                            default=[1000, 10000, 100000, 1000000])
+        parser.add_argument('--repeat', type=int, default=200)
+
+    def handle(self, *args, **options):
+        """Run the benchmark."""
+        try:
+            performance = Performance.objects.get(id=options['performance'])
+        except Performance.DoesNotExist:
+            raise CommandError("Unknown performance.")
+
+        repeat = options['repeat']
+        self.stdout.write("%10s %12s %12s %12s" % (
+            'orders', 'hash (ms)', 'code (ms)', 'perf (ms)'))
+        with transaction.atomic():
+            seeded = 0
+            for size in sorted(options['sizes']):
+                seeded += seed_orders(performance, size - seeded)
+                hashes = random.sample(list(Order.objects.filter(
+                    performance=performance).values_list('hash', flat=True)[
+                    :10000]), k=min(repeat, seeded))
+                codes = random.sample(list(Ticket.objects.filter(
+                    order__performance=performance).values_list(
+                    'code', flat=True)[:10000]), k=min(repeat, seeded))
+
+                by_hash = timed(lambda i: Order.objects.filter(
+                    hash=hashes[i % len(hashes)]).exists(), repeat)
+                by_code = timed(lambda i: Ticket.objects.filter(
+                    code=codes[i % len(codes)]).exists(), repeat)
+                by_performance = timed(lambda i: list(Order.objects.filter(
+                    performance=performance).order_by('date')[:100]), repeat)
+                self.stdout.write("%10d %12.3f %12.3f %12.3f" % (
+                    size, by_hash, by_code, by_performance))
+            transaction.set_rollback(True)
@@ -0,0 +1,82 @@
+"""Benchmark every ticketing view against a synthetic season."""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import setup_test_environment, \
+    teardown_test_environment, override_settings
+from ...benchmark import QUERY_BUDGETS, ViewBenchmark, percentile, \
+    seed_season
+from ...caching import invalidate_overview, invalidate_availability
+from ...pdf import invalidate_tickets_pdf
+from ...scan_log import scan_log
+
+
+class Command(BaseCommand):
+    """Report latency percentiles and query counts per view."""
+
+    help = ("Seed a synthetic season (rolled back afterwards), drive every "
+            "ticketing view through the test client and check the query "
+            "budgets.")
+
+    def add_arguments(self, parser):
+        """Add arguments."""
+        parser.add_argument('--productions', type=int, default=1)
+        parser.add_argument('--performances', type=int, default=3)
+        parser.add_argument('--categories', type=int, default=3)
+        parser.add_argument('--orders', type=int, default=1000,
+                            help="Orders per performance.")
+        parser.add_argument('--tickets', type=int, default=2,
+                            help="Tickets per order.")
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        """Run the benchmark."""
+        try:
+            setup_test_environment()
+        except RuntimeError:
+            # Already set up, e.g. when called from a test
+            teardown = False
+        else:
+            teardown = True
+
+        over_budget = []
+        payed = []
+        try:
+            # The scans of the rolled back season stay in the buffer until
+            # it is cleared
+            with transaction.atomic(), override_settings(
+                    TICKETING_SCAN_LOG_SIZE=10 ** 9,
+                    TICKETING_SCAN_LOG_AGE=10 ** 9):
+                season = seed_season(
+                    options['productions'], options['performances'],
+                    options['categories'], options['orders'],
+                    options['tickets'])
+                benchmark = ViewBenchmark(season)
+                payed = [id for id, code in benchmark.payed]
+
+                self.stdout.write("%-18s %9s %9s %9s %8s %7s" % (
+                    'view', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'queries',
+                    'budget'))
+                for name, view in benchmark.views():
+                    durations, queries = benchmark.run(
+                        view, options['repeat'])
+                    budget = QUERY_BUDGETS.get(name)
+                    self.stdout.write("%-18s %9.1f %9.1f %9.1f %8d %7s" % (
+                        name, percentile(durations, 50),
+                        percentile(durations, 90), percentile(durations, 99),
+                        queries, budget))
+                    if budget is not None and queries > budget:
+                        over_budget.append(name)
+                transaction.set_rollback(True)
+        finally:
+            scan_log.clear()
+            if teardown:
+                teardown_test_environment()
+            invalidate_overview()
+            invalidate_availability()
+            for id in payed:
+                invalidate_tickets_pdf(id)
+
+        if over_budget:
+            raise CommandError("Over the query budget: %s" % ', '.join(
+                over_budget))
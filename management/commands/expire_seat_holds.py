@@ -0,0 +1,30 @@
+"""Release the seats of expired holds."""
+
+import time
+from django.core.management.base import BaseCommand
+from ...inventory import expire_holds
+
+
+class Command(BaseCommand):
+    """Sweep expired seat holds."""
+
+    help = "Release the seats held by buyers who did not finish their order."
+
+    def add_arguments(self, parser):
+        """Add arguments."""
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Holds released per transaction.")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep sweeping.")
+        parser.add_argument('--interval', type=float, default=30,
+                            help="Seconds between sweeps.")
+
+    def handle(self, *args, **options):
+        """Sweep the holds."""
+        while True:
+            expired = expire_holds(options['batch_size'])
+            if expired:
+                self.stdout.write("Released %d seat holds." % expired)
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,31 @@
+"""Export the offline scanner manifest of a performance."""
+
+from django.core.management.base import BaseCommand, CommandError
+from ...models import Performance
+from ...scanning import build_manifest, manifest_gzip
+
+
+class Command(BaseCommand):
+    """Write the manifest for door-check devices to a file."""
+
+    help = "Export the gzipped ticket manifest of a performance."
+
+    def add_arguments(self, parser):
+        """Add arguments."""
+        parser.add_argument('performance', type=int)
+        parser.add_argument('-o', '--output', default=None,
+                            help="Defaults to manifest-<performance>.json.gz")
+
+    def handle(self, *args, **options):
+        """Export the manifest."""
+        try:
+            performance = Performance.objects.get(id=options['performance'])
+        except Performance.DoesNotExist:
+            raise CommandError("Unknown performance.")
+
+        manifest = build_manifest(performance)
+        output = options['output'] or 'manifest-%d.json.gz' % performance.id
+        with open(output, 'wb') as f:
+            f.write(manifest_gzip(manifest))
+        self.stdout.write("Wrote %d tickets (version %s) to %s." % (
+            len(manifest['tickets']), manifest['version'], output))
@@ -0,0 +1,56 @@
+"""Export the orders and tickets of a production or a range of dates."""
+
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from ...export import EXPORTERS, export_rows, select_orders, parse_bound
+from ...models import Production
+
+
+class Command(BaseCommand):
+    """Bulk export of orders, one row per ticket."""
+
+    help = ("Export every ticket of a production and/or of the performances "
+            "between two dates.")
+
+    def add_arguments(self, parser):
+        """Add arguments."""
+        parser.add_argument('--production', type=int, default=None)
+        parser.add_argument('--from', dest='start', default=None,
+                            help="First performance date (YYYY-MM-DD).")
+        parser.add_argument('--to', dest='end', default=None,
+                            help="Last performance date (YYYY-MM-DD).")
+        parser.add_argument('--format', default='csv',
+                            choices=sorted(EXPORTERS))
+        parser.add_argument('-o', '--output', default=None,
+                            help="Defaults to standard output.")
+
+    def handle(self, *args, **options):
+        """Export."""
+        exporter = EXPORTERS[options['format']]
+        if not exporter.available():
+            raise CommandError(
+                "The %s format has missing dependencies." % exporter.name)
+
+        production = None
+        if options['production'] is not None:
+            try:
+                production = Production.objects.get(id=options['production'])
+            except Production.DoesNotExist:
+                raise CommandError("Unknown production.")
+        try:
+            start = parse_bound(options['start'])
+            end = parse_bound(options['end'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        rows = export_rows(select_orders(production, start, end))
+        if options['output']:
+            output = open(options['output'], 'wb')
+        else:
+            output = sys.stdout.buffer
+        try:
+            for chunk in exporter().stream(rows):
+                output.write(chunk)
+        finally:
+            if options['output']:
+                output.close()
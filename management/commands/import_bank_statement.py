@@ -0,0 +1,40 @@
+"""Mark the orders payed by the transfers on a bank statement."""
+
+from django.core.management.base import BaseCommand, CommandError
+from ...bank import FORMATS, import_statement, report_lines
+
+
+class Command(BaseCommand):
+    """Reconcile a bank statement with the online orders."""
+
+    help = ("Match the transfers of a CSV or CODA statement with the online "
+            "orders, mark them payed and send their tickets.")
+
+    def add_arguments(self, parser):
+        """Add arguments."""
+        parser.add_argument('statement')
+        parser.add_argument('--format', default=None, choices=FORMATS,
+                            help="Defaults to coda for .cod files, csv "
+                                 "otherwise.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report, change nothing.")
+
+    def handle(self, *args, **options):
+        """Import."""
+        statement_format = options['format'] or (
+            'coda' if options['statement'].lower().endswith(
+                ('.cod', '.coda')) else 'csv')
+        try:
+            with open(options['statement'], 'rb') as f:
+                result, payed = import_statement(
+                    f.read(), statement_format, options['dry_run'])
+        except (OSError, ValueError) as e:
+            raise CommandError(e)
+
+        for line in report_lines(result):
+            self.stdout.write(line)
+        if options['dry_run']:
+            self.stdout.write("%d orders would be marked payed." % len(
+                result.payed))
+        else:
+            self.stdout.write("%d orders marked payed." % payed)
@@ -0,0 +1,15 @@
+"""Recompute the sales aggregates used by the stats."""
+
+from django.core.management.base import BaseCommand
+from ...aggregates import rebuild_aggregates
+
+
+class Command(BaseCommand):
+    """Rebuild the sales aggregates from all orders."""
+
+    help = "Recompute the sales per performance, hour and seller."
+
+    def handle(self, *args, **options):
+        """Rebuild."""
+        rows = rebuild_aggregates()
+        self.stdout.write("Rebuilt %d sales aggregates." % rows)
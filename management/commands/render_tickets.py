@@ -0,0 +1,45 @@
+"""Render the ticket PDFs of a performance in bulk."""
+
+import time
+from django.core.management.base import BaseCommand, CommandError
+from ...models import OnlineOrder, Performance
+from ...pdf import render_orders
+
+
+class Command(BaseCommand):
+    """Render and store tickets over several processes."""
+
+    help = "Render and store the ticket PDFs of all orders of a performance."
+
+    def add_arguments(self, parser):
+        """Add arguments."""
+        parser.add_argument('--performance', type=int, required=True)
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Rendering processes (default: all cores).")
+        parser.add_argument('--unpayed', action='store_true',
+                            help="Also render orders that are not payed.")
+
+    def handle(self, *args, **options):
+        """Render the tickets."""
+        try:
+            performance = Performance.objects.get(id=options['performance'])
+        except Performance.DoesNotExist:
+            raise CommandError("Unknown performance.")
+
+        orders = OnlineOrder.objects.filter(performance=performance)
+        if not options['unpayed']:
+            orders = orders.filter(payed=True)
+        order_ids = list(orders.values_list('id', flat=True))
+
+        start = time.monotonic()
+        failed = 0
+        for order_id, error in render_orders(order_ids, options['workers']):
+            if error:
+                failed += 1
+                self.stderr.write("Order %d failed: %s" % (order_id, error))
+        duration = time.monotonic() - start
+
+        self.stdout.write(
+            "Rendered %d orders of %s in %.1fs (%.1f orders/s), %d failed." % (
+                len(order_ids) - failed, performance, duration,
+                len(order_ids) / duration if duration else 0, failed))
@@ -0,0 +1,64 @@
+"""Report the entrance throughput of a performance."""
+
+from collections import defaultdict
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import localtime
+from ...models import Performance
+from ...scan_log import scans_per_minute, duplicate_scans, gate_totals
+
+
+class Command(BaseCommand):
+    """Scans per minute and gate, and tickets scanned more than once."""
+
+    help = ("Report the scans at the door of a performance. Scans are "
+            "written by the web workers within TICKETING_SCAN_LOG_AGE "
+            "seconds.")
+
+    def add_arguments(self, parser):
+        """Add arguments."""
+        parser.add_argument('performance', type=int)
+        parser.add_argument('--duplicates', type=int, default=20,
+                            help="Tickets scanned more than once to list.")
+
+    def handle(self, *args, **options):
+        """Report."""
+        try:
+            performance = Performance.objects.get(id=options['performance'])
+        except Performance.DoesNotExist:
+            raise CommandError("Unknown performance.")
+
+        minutes = list(scans_per_minute(performance))
+        gates = sorted({row['gate'] for row in minutes})
+        per_minute = defaultdict(dict)
+        for row in minutes:
+            per_minute[row['minute']][row['gate']] = row['scans']
+
+        self.stdout.write("%-6s %s" % ("minute", " ".join(
+            "%8s" % (gate or '?')[:8] for gate in gates)))
+        for minute, counts in sorted(per_minute.items()):
+            self.stdout.write("%-6s %s" % (
+                localtime(minute).strftime('%H:%M'), " ".join(
+                    "%8d" % counts.get(gate, 0) for gate in gates)))
+
+        self.stdout.write("")
+        peaks = defaultdict(int)
+        for row in minutes:
+            peaks[row['gate']] = max(peaks[row['gate']], row['scans'])
+        for row in gate_totals(performance):
+            self.stdout.write("%-10s %-18s %6d" % (
+                row['gate'] or '?', row['status'], row['scans']))
+        for gate in gates:
+            self.stdout.write("Peak at %s: %d scans per minute." % (
+                gate or '?', peaks[gate]))
+
+        duplicates = list(duplicate_scans(performance)[
+            :options['duplicates']])
+        if duplicates:
+            self.stdout.write("")
+            self.stdout.write("Tickets scanned more than once:")
+        for row in duplicates:
+            self.stdout.write(
+                "ticket %d: %d scans at %d gates, %s - %s" % (
+                    row['ticket'], row['scans'], row['gates'],
+                    localtime(row['first']).strftime('%H:%M:%S'),
+                    localtime(row['last']).strftime('%H:%M:%S')))
@@ -0,0 +1,35 @@
+"""Deliver the mails waiting in the ticketing outbox."""
+
+import time
+from django.core.management.base import BaseCommand
+from ...outbox import deliver_queued
+
+
+class Command(BaseCommand):
+    """Mail worker for the ticketing outbox."""
+
+    help = "Deliver queued ticketing mails over a single connection."
+
+    def add_arguments(self, parser):
+        """Add arguments."""
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help="Mails sent per connection.")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep polling the outbox.")
+        parser.add_argument('--interval', type=float, default=5,
+                            help="Seconds to wait when the outbox is empty.")
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Processes rendering tickets, 0 renders "
+                                 "them while sending.")
+
+    def handle(self, *args, **options):
+        """Drain the outbox."""
+        while True:
+            sent, failed = deliver_queued(options['batch_size'],
+                                          options['workers'])
+            if sent or failed:
+                self.stdout.write("Sent %d mails, %d failed." % (sent, failed))
+            elif options['loop']:
+                time.sleep(options['interval'])
+            else:
+                break
@@ -0,0 +1,119 @@
+"""
+Timing and query instrumentation.
+
+Set ``TICKETING_METRICS = True`` and add
+``orchestra_season.metrics.MetricsMiddleware`` to the middleware to record
+the duration, number of queries and errors of every view. Expensive steps
+(PDF rendering, mails, scans) are recorded with the ``timed`` context
+manager. The numbers are kept per process and exposed in the Prometheus
+text format on the ``tickets:metrics`` page. When disabled, the middleware
+removes itself and ``timed`` does nothing.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+_lock = threading.Lock()
+# name -> [calls, errors, seconds, queries]
+_metrics = {}
+
+
+def enabled():
+    """Whether metrics are recorded."""
+    return getattr(settings, 'TICKETING_METRICS', False)
+
+
+def record(name: str, seconds: float, queries: int, error: bool = False):
+    """Add a measurement."""
+    with _lock:
+        values = _metrics.setdefault(name, [0, 0, 0.0, 0])
+        values[0] += 1
+        values[1] += int(error)
+        values[2] += seconds
+        values[3] += queries
+
+
+def reset():
+    """Forget all measurements."""
+    with _lock:
+        _metrics.clear()
+
+
+class QueryCounter:
+    """Database execute wrapper counting the queries."""
+
+    def __init__(self):
+        """Start at zero."""
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        """Count and execute a query."""
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def timed(name: str):
+    """Record the duration and queries of a block."""
+    if not enabled():
+        yield
+        return
+
+    counter = QueryCounter()
+    start = time.perf_counter()
+    error = False
+    try:
+        with connection.execute_wrapper(counter):
+            yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        record(name, time.perf_counter() - start, counter.count, error)
+
+
+class MetricsMiddleware:
+    """Record every view."""
+
+    def __init__(self, get_response):
+        """Only install when metrics are enabled."""
+        if not enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        """Time the request."""
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with connection.execute_wrapper(counter):
+            response = self.get_response(request)
+        match = request.resolver_match
+        record('view:%s' % (match.view_name if match else 'unresolved'),
+               time.perf_counter() - start, counter.count,
+               response.status_code >= 500)
+        return response
+
+
+def prometheus_text():
+    """All measurements in the Prometheus text format."""
+    with _lock:
+        metrics = sorted((name, list(values))
+                         for name, values in _metrics.items())
+
+    lines = []
+    for index, (metric, kind, description) in enumerate([
+            ('ticketing_calls_total', 'counter', "Number of calls."),
+            ('ticketing_errors_total', 'counter', "Number of failed calls."),
+            ('ticketing_seconds_total', 'counter', "Time spent."),
+            ('ticketing_queries_total', 'counter', "Database queries.")]):
+        lines.append('# HELP %s %s' % (metric, description))
+        lines.append('# TYPE %s %s' % (metric, kind))
+        for name, values in metrics:
+            lines.append('%s{name="%s"} %s' % (
+                metric, name.replace('\\', '\\\\').replace('"', '\\"'),
+                values[index]))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,29 @@
+# Generated by Django 4.0.2 on 2026-10-17 10:12
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_tickets_sold(apps, schema_editor):
+    """Backfill the seat inventory from the existing tickets."""
+    Performance = apps.get_model('orchestra_season', 'Performance')
+    for performance in Performance.objects.annotate(
+            sold=Count('orders__tickets')):
+        Performance.objects.filter(id=performance.id).update(
+            tickets_sold=performance.sold)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestra_season', '0007_remove_production_season_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='performance',
+            name='tickets_sold',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_tickets_sold, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.0.2 on 2026-10-17 10:48
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestra_season', '0008_performance_tickets_sold'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutgoingMail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('subject', models.CharField(max_length=255)),
+                ('sender', models.CharField(max_length=255)),
+                ('to', models.TextField(help_text='One address per line.')),
+                ('cc', models.TextField(blank=True, help_text='One address per line.')),
+                ('body', models.TextField()),
+                ('html_body', models.TextField(blank=True)),
+                ('attachment', models.BinaryField(blank=True, null=True)),
+                ('attachment_name', models.CharField(blank=True, max_length=100)),
+                ('attachment_type', models.CharField(blank=True, max_length=100)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('sent', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='mails', to='orchestra_season.order')),
+            ],
+        ),
+    ]
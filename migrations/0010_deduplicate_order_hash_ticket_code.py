@@ -0,0 +1,44 @@
+# Generated by Django 4.0.2 on 2026-10-17 13:01
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def deduplicate(apps, schema_editor):
+    """
+    Make order hashes and ticket codes unique before they get constrained.
+
+    The oldest order keeps its hash, later duplicates (double submits) get
+    their id appended. Duplicate ticket codes get a new random code, codes
+    of tickets sold at the register are left alone.
+    """
+    from orchestra_season.models import random_key
+    Order = apps.get_model('orchestra_season', 'Order')
+    Ticket = apps.get_model('orchestra_season', 'Ticket')
+
+    duplicates = Order.objects.values('hash').annotate(
+        n=Count('id')).filter(n__gt=1)
+    for row in duplicates:
+        for order in Order.objects.filter(
+                hash=row['hash']).order_by('id')[1:]:
+            order.hash = '%s-%d' % (row['hash'][:100], order.id)
+            order.save(update_fields=['hash'])
+
+    duplicates = Ticket.objects.exclude(code__contains='kassaticket').values(
+        'code').annotate(n=Count('id')).filter(n__gt=1)
+    for row in duplicates:
+        for ticket in Ticket.objects.filter(
+                code=row['code']).order_by('id')[1:]:
+            ticket.code = random_key()
+            ticket.save(update_fields=['code'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestra_season', '0009_outgoingmail'),
+    ]
+
+    operations = [
+        migrations.RunPython(deduplicate, migrations.RunPython.noop),
+    ]
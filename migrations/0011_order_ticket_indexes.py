@@ -0,0 +1,32 @@
+# Generated by Django 4.0.2 on 2026-10-17 13:05
+
+import orchestra_season.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestra_season', '0010_deduplicate_order_hash_ticket_code'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='hash',
+            field=models.CharField(max_length=128, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='ticket',
+            name='code',
+            field=models.CharField(db_index=True, default=orchestra_season.models.random_key, max_length=18),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['performance', 'date'], name='order_performance_date_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='ticket',
+            constraint=models.UniqueConstraint(condition=models.Q(('code__contains', 'kassaticket'), _negated=True), fields=('code',), name='unique_ticket_code'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.0.2 on 2026-10-17 14:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncHour
+
+
+def aggregate_sales(apps, schema_editor):
+    """Fill the aggregates from the existing orders."""
+    Order = apps.get_model('orchestra_season', 'Order')
+    SalesAggregate = apps.get_model('orchestra_season', 'SalesAggregate')
+    rows = Order.objects.annotate(bucket=TruncHour('date')).values(
+        'performance_id', 'bucket', 'seller_id').annotate(
+        num_orders=Count('id', distinct=True), num_tickets=Count('tickets'),
+    ).order_by()
+    SalesAggregate.objects.bulk_create([
+        SalesAggregate(
+            performance_id=row['performance_id'], bucket=row['bucket'],
+            seller_id=row['seller_id'], orders=row['num_orders'],
+            tickets=row['num_tickets'])
+        for row in rows
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestra_season', '0011_order_ticket_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SalesAggregate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField(verbose_name='Start of the hour')),
+                ('orders', models.IntegerField(default=0)),
+                ('tickets', models.IntegerField(default=0)),
+                ('performance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sales', to='orchestra_season.performance')),
+                ('seller', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['performance', 'bucket'], name='sales_performance_bucket_idx')],
+            },
+        ),
+        migrations.RunPython(aggregate_sales, migrations.RunPython.noop),
+    ]
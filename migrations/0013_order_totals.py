@@ -0,0 +1,41 @@
+# Generated by Django 4.0.2 on 2026-10-17 15:31
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def store_totals(apps, schema_editor):
+    """Backfill the totals of the existing orders."""
+    Order = apps.get_model('orchestra_season', 'Order')
+    orders = []
+    for order in Order.objects.annotate(
+            count=Count('tickets'),
+            amount=Sum('tickets__price_category__price')).iterator():
+        order.ticket_count = order.count
+        order.total_amount = order.amount or 0
+        orders.append(order)
+        if len(orders) == 1000:
+            Order.objects.bulk_update(orders, ['ticket_count', 'total_amount'])
+            orders = []
+    Order.objects.bulk_update(orders, ['ticket_count', 'total_amount'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestra_season', '0012_salesaggregate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='ticket_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_amount',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.RunPython(store_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.0.2 on 2026-10-17 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestra_season', '0013_order_totals'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='onlineorder',
+            name='email',
+            field=models.EmailField(db_index=True, max_length=254),
+        ),
+        migrations.AddIndex(
+            model_name='onlineorder',
+            index=models.Index(fields=['last_name', 'first_name'], name='onlineorder_name_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.0.2 on 2026-10-17 18:02
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestra_season', '0014_onlineorder_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='performance',
+            name='seats_held',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='SeatHold',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seats', models.IntegerField()),
+                ('token', models.CharField(max_length=100, unique=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('expires', models.DateTimeField(db_index=True)),
+                ('performance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holds', to='orchestra_season.performance')),
+            ],
+        ),
+    ]
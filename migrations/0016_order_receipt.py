@@ -0,0 +1,18 @@
+# Generated by Django 4.0.2 on 2026-10-17 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestra_season', '0015_seathold'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='receipt',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.2 on 2026-10-17 19:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestra_season', '0016_order_receipt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outgoingmail',
+            name='attach_tickets',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.0.2 on 2026-10-17 21:30
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestra_season', '0017_outgoingmail_attach_tickets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScanEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gate', models.CharField(blank=True, max_length=50)),
+                ('scanned_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('status', models.CharField(max_length=20)),
+                ('performance', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='scans', to='orchestra_season.performance')),
+                ('ticket', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='scans', to='orchestra_season.ticket')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['performance', 'scanned_at'], name='scan_performance_time_idx')],
+            },
+        ),
+    ]
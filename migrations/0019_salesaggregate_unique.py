@@ -0,0 +1,43 @@
+# Generated by Django 4.0.2 on 2026-10-17 22:10
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def merge_duplicates(apps, schema_editor):
+    """Merge the rows created twice by concurrent sales."""
+    SalesAggregate = apps.get_model('orchestra_season', 'SalesAggregate')
+    duplicates = SalesAggregate.objects.values(
+        'performance_id', 'bucket', 'seller_id').annotate(
+        n=Count('id'), num_orders=Sum('orders'), num_tickets=Sum('tickets'),
+    ).filter(n__gt=1).order_by()
+    for row in duplicates:
+        rows = SalesAggregate.objects.filter(
+            performance_id=row['performance_id'], bucket=row['bucket'],
+            seller_id=row['seller_id']).order_by('id')
+        first = rows[0]
+        rows.exclude(id=first.id).delete()
+        first.orders = row['num_orders']
+        first.tickets = row['num_tickets']
+        first.save(update_fields=['orders', 'tickets'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestra_season', '0018_scanevent'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='salesaggregate',
+            constraint=models.UniqueConstraint(fields=('performance', 'bucket', 'seller'), name='sales_performance_bucket_seller_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='salesaggregate',
+            constraint=models.UniqueConstraint(condition=models.Q(('seller', None)), fields=('performance', 'bucket'), name='sales_performance_bucket_online_uniq'),
+        ),
+    ]
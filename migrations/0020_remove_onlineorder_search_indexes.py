@@ -0,0 +1,22 @@
+# Generated by Django 4.0.2 on 2026-10-17 22:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestra_season', '0019_salesaggregate_unique'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='onlineorder',
+            name='onlineorder_name_idx',
+        ),
+        migrations.AlterField(
+            model_name='onlineorder',
+            name='email',
+            field=models.EmailField(max_length=254),
+        ),
+    ]
@@ -8,15 +8,18 @@ Each production having multiple performances.
 from django.db import models
 from django.db.models import Model, CharField, ImageField, BooleanField, \
     ForeignKey, ManyToManyField, IntegerField, FloatField, DateTimeField, \
-    TextField, EmailField
+    TextField, EmailField, BinaryField, JSONField
 from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
 from django.utils.timezone import get_current_timezone, now
 from django.utils import timezone
 from model_utils.managers import InheritanceManager
 from string import ascii_lowercase
-from random import choices
+from secrets import choice
 from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.utils.crypto import salted_hmac
+from hashlib import sha256
 
 
 class Location(Model):
@@ -83,6 +86,34 @@ class Performance(Model):
     close_sales = DateTimeField('Close ticket sales', default=now)
     close_paper_sales = DateTimeField(
         'Close paper sales (by members)', default=now)
+    # Seat inventory, maintained by inventory.reserve_seats and hold_seats
+    tickets_sold = IntegerField(default=0, editable=False)
+    seats_held = IntegerField(default=0, editable=False)
+    COUNTERS = ('tickets_sold', 'seats_held')
+
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        """
+        Save a performance, without writing back its seat counters.
+
+        The counters are only changed by the conditional updates of
+        ``inventory``, a stale instance saved by the admin would otherwise
+        reset them and oversell the performance.
+        """
+        if not self._state.adding and not force_insert:
+            if update_fields is None:
+                update_fields = [field.name for field in
+                                 self._meta.concrete_fields
+                                 if not field.primary_key]
+            update_fields = [name for name in update_fields
+                             if name not in self.COUNTERS]
+        super().save(force_insert=force_insert, force_update=force_update,
+                     using=using, update_fields=update_fields)
+
+    @property
+    def remaining_seats(self):
+        """Seats that can still be sold or held."""
+        return max(self.seats - self.tickets_sold - self.seats_held, 0)
 
     @property
     def price_categories_as_string(self):
@@ -107,6 +138,23 @@ class Performance(Model):
                                             self.location)
 
 
+class SeatHold(Model):
+    """Seats kept for a buyer while they fill in the order form."""
+
+    performance = ForeignKey(Performance, related_name='holds',
+                             on_delete=models.CASCADE)
+    seats = IntegerField()
+    token = CharField(max_length=100, unique=True)
+    created = DateTimeField(default=now)
+    expires = DateTimeField(db_index=True)
+
+    def __str__(self):
+        """Represent a hold."""
+        return '{} seats for {} until {:%H:%M:%S}.'.format(
+            self.seats, self.performance,
+            self.expires.astimezone(get_current_timezone()))
+
+
 class Order(Model):
     """Abstract model for an Order."""
 
@@ -118,20 +166,42 @@ class Order(Model):
                         blank=True, null=True, on_delete=models.SET_NULL)
     remarks = TextField(blank=True, null=True)
     payed = BooleanField(default=False)
-    hash = CharField(max_length=128)
+    hash = CharField(max_length=128, unique=True)
+    # Totals of the tickets, stored when the order is created
+    ticket_count = IntegerField(default=0, editable=False)
+    total_amount = FloatField(default=0, editable=False)
+    # Confirmation shown again when the order form is submitted twice
+    receipt = JSONField(blank=True, null=True, editable=False)
     # Extra information
     objects = InheritanceManager()
 
+    class Meta:
+        """Lookups by stats and exports."""
+
+        indexes = [
+            models.Index(fields=['performance', 'date'],
+                         name='order_performance_date_idx'),
+        ]
+
     @property
     def num_tickets(self):
         """Count all tickets."""
-        return len(self.tickets.all())
+        return self.ticket_count
 
     @property
     def total_price(self):
         """Total price of the order."""
-        return sum([ticket.price_category.price
-                    for ticket in self.tickets.all()])
+        return self.total_amount
+
+    def update_totals(self):
+        """Recompute the stored totals from the tickets."""
+        totals = self.tickets.aggregate(
+            count=models.Count('id'),
+            amount=models.Sum('price_category__price'))
+        self.ticket_count = totals['count']
+        self.total_amount = totals['amount'] or 0
+        Order.objects.filter(id=self.id).update(
+            ticket_count=self.ticket_count, total_amount=self.total_amount)
 
     def __str__(self):
         """Represent an order."""
@@ -140,6 +210,42 @@ class Order(Model):
             self.seller, self.date.astimezone(get_current_timezone()))
 
 
+class SalesAggregate(Model):
+    """Orders and tickets sold per performance, hour and seller."""
+
+    performance = ForeignKey(
+        Performance, related_name='sales', on_delete=models.CASCADE)
+    bucket = DateTimeField(_("Start of the hour"))
+    seller = ForeignKey(get_user_model(),
+                        blank=True, null=True, on_delete=models.SET_NULL)
+    orders = IntegerField(default=0)
+    tickets = IntegerField(default=0)
+
+    class Meta:
+        """Lookups by the stats, one row per performance, hour and seller."""
+
+        indexes = [
+            models.Index(fields=['performance', 'bucket'],
+                         name='sales_performance_bucket_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['performance', 'bucket', 'seller'],
+                name='sales_performance_bucket_seller_uniq'),
+            # NULLs are distinct in the constraint above
+            models.UniqueConstraint(
+                fields=['performance', 'bucket'],
+                condition=models.Q(seller=None),
+                name='sales_performance_bucket_online_uniq'),
+        ]
+
+    def __str__(self):
+        """Represent an aggregate."""
+        return '{} tickets for {} sold by {} from {:%d-%m-%Y %H:%M}.'.format(
+            self.tickets, self.performance, self.seller,
+            self.bucket.astimezone(get_current_timezone()))
+
+
 CHOICES = (
     (None, _("- Choose -")),
     (True, _("Yes")),
@@ -188,7 +294,42 @@ class OnlineOrder(Order):
 
 def random_key():
     """Random key."""
-    return ''.join(choices(ascii_lowercase, k=18))
+    return ''.join(choice(ascii_lowercase) for i in range(18))
+
+
+SIGNED_CODE_PREFIX = 'v2-'
+
+
+def qr_key():
+    """Key of the QR code signatures, TICKETING_QR_KEY should be set."""
+    return getattr(settings, 'TICKETING_QR_KEY', None) or settings.SECRET_KEY
+
+
+def code_tag(code: str):
+    """Short digest of a stored ticket code."""
+    return sha256(code.encode()).hexdigest()[:8]
+
+
+def sign_code(id: int, performance_id: int, tag: str):
+    """Signed code ``v2-<performance id>-<tag>-<signature>``."""
+    signature = salted_hmac(
+        'orchestra_season.ticket', '%d:%d:%s' % (id, performance_id, tag),
+        secret=qr_key(), algorithm='sha256').hexdigest()[:16]
+    return '%s%d-%s-%s' % (SIGNED_CODE_PREFIX, performance_id, tag,
+                           signature)
+
+
+def signed_code(id: int, performance_id: int, code: str):
+    """
+    Signed code of a ticket.
+
+    The signature covers the ticket, its performance and a tag of its
+    stored code, so scanners can reject forged codes without looking them
+    up, and giving a ticket a new code revokes the printed one. It is made
+    with TICKETING_QR_KEY, or the SECRET_KEY when that is not set (rotating
+    that key then revokes all printed tickets).
+    """
+    return sign_code(id, performance_id, code_tag(code))
 
 
 class Ticket(Model):
@@ -197,19 +338,93 @@ class Ticket(Model):
     price_category = ForeignKey(PriceCategory, on_delete=models.CASCADE)
     order = ForeignKey(Order, related_name='tickets',
                        on_delete=models.CASCADE)
-    code = CharField(max_length=18, default=random_key)
+    code = CharField(max_length=18, default=random_key, db_index=True)
     used = BooleanField(default=False)
 
+    class Meta:
+        """The code is the credential of a ticket (except at the register)."""
+
+        constraints = [
+            models.UniqueConstraint(
+                fields=['code'], condition=~models.Q(
+                    code__contains='kassaticket'),
+                name='unique_ticket_code'),
+        ]
+
     def __str__(self):
         """Represent an online order."""
         return 'Ticket of €{:g} for {}, part of {}'.format(
             self.price_category.price, self.order.performance, str(self.order))
 
+    @property
+    def scan_code(self):
+        """Code in the QR code, signed except for cash tickets."""
+        if 'kassaticket' in self.code:
+            return self.code
+        return signed_code(self.id, self.order.performance_id, self.code)
+
     @property
     def qr_code(self):
         """QR code."""
         return 'https://alumniarenbergorkest.be' + (
             reverse('tickets:qr_info', kwargs={
                 'id': self.id,
-                'code': self.code,
+                'code': self.scan_code,
             }))
+
+
+class ScanEvent(Model):
+    """A scan at the door, written in batches by scan_log."""
+
+    # No constraint: buffered events may be written after their ticket
+    # is removed, and the log keeps the id of removed tickets.
+    ticket = ForeignKey(Ticket, related_name='scans', blank=True, null=True,
+                        db_constraint=False, on_delete=models.DO_NOTHING)
+    performance = ForeignKey(Performance, related_name='scans', blank=True,
+                             null=True, on_delete=models.CASCADE)
+    gate = CharField(max_length=50, blank=True)
+    scanned_at = DateTimeField(default=now)
+    # A scanning.ScanStatus value
+    status = CharField(max_length=20)
+
+    class Meta:
+        """Lookups by the scan reports."""
+
+        indexes = [
+            models.Index(fields=['performance', 'scanned_at'],
+                         name='scan_performance_time_idx'),
+        ]
+
+    def __str__(self):
+        """Represent a scan."""
+        return '{} scan of ticket {} at {} on {:%d-%m-%Y %H:%M:%S}.'.format(
+            self.status, self.ticket_id, self.gate or '?',
+            self.scanned_at.astimezone(get_current_timezone()))
+
+
+class OutgoingMail(Model):
+    """A mail waiting in the outbox to be delivered by the mail worker."""
+
+    created = DateTimeField(default=now)
+    order = ForeignKey(Order, related_name='mails', blank=True, null=True,
+                       on_delete=models.SET_NULL)
+    subject = CharField(max_length=255)
+    sender = CharField(max_length=255)
+    to = TextField(help_text=_("One address per line."))
+    cc = TextField(blank=True, help_text=_("One address per line."))
+    body = TextField()
+    html_body = TextField(blank=True)
+    attachment = BinaryField(blank=True, null=True)
+    attachment_name = CharField(max_length=100, blank=True)
+    attachment_type = CharField(max_length=100, blank=True)
+    # Attach the stored tickets of the order when the mail is delivered
+    attach_tickets = BooleanField(default=False)
+    # Delivery state
+    attempts = IntegerField(default=0)
+    next_attempt = DateTimeField(default=now, db_index=True)
+    sent = DateTimeField(blank=True, null=True, db_index=True)
+    last_error = TextField(blank=True)
+
+    def __str__(self):
+        """Represent a mail."""
+        return '{} to {}'.format(self.subject, ', '.join(self.to.split()))
@@ -0,0 +1,217 @@
+"""
+Transactional outbox for ticketing mails.
+
+Views never talk to the mail server. They store their messages with
+``queue_mail`` in the transaction that creates the order, and the
+``send_queued_mail`` management command delivers them in batches over a
+single connection, retrying failed messages with an exponential backoff.
+
+Mails queued with ``attach_tickets`` get the ticket PDF of their order
+attached when they are delivered, the worker renders the missing PDFs of a
+batch in parallel before sending it.
+"""
+
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import connection, transaction
+from django.template.loader import render_to_string
+from django.utils import translation
+from django.utils.timezone import now
+from django.utils.translation import gettext
+from .metrics import timed
+from .models import Order, OnlineOrder, OutgoingMail
+from .pdf import tickets_data, tickets_pdf_name, open_tickets_pdf, \
+    render_orders
+
+SENDER = "Alumni Arenbergorkest <noreply-ticketing@alumniarenbergorkest.be>"
+
+log = logging.getLogger('django.request.mail')
+
+
+def _max_attempts():
+    return getattr(settings, 'TICKETING_MAIL_MAX_ATTEMPTS', 5)
+
+
+def _retry_delay(attempts: int):
+    """Backoff before the next attempt: 1, 2, 4, 8... minutes."""
+    base = getattr(settings, 'TICKETING_MAIL_RETRY_DELAY', 60)
+    return timedelta(seconds=base * 2 ** (attempts - 1))
+
+
+def _outgoing_mail(email: EmailMultiAlternatives, order: Order = None):
+    mail = OutgoingMail(
+        order=order,
+        subject=str(email.subject),
+        sender=email.from_email,
+        to='\n'.join(email.to),
+        cc='\n'.join(email.cc),
+        body=email.body,
+    )
+    for content, mimetype in email.alternatives:
+        if mimetype == 'text/html':
+            mail.html_body = content
+    if email.attachments:
+        name, content, mimetype = email.attachments[0]
+        mail.attachment = content
+        mail.attachment_name = name
+        mail.attachment_type = mimetype
+    return mail
+
+
+def queue_mail(email: EmailMultiAlternatives, order: Order = None):
+    """Store a mail in the outbox."""
+    mail = _outgoing_mail(email, order)
+    mail.save()
+    return mail
+
+
+def tickets_email(order: OnlineOrder, data: dict, subject: str = None):
+    """The mail with the tickets of a payed order, without the PDF."""
+    with translation.override(order.language):
+        if subject is None:
+            subject = gettext("Tickets: %s") % (
+                order.performance.production.name)
+        message_plain = render_to_string(
+            'ticketing/mail/tickets_plain.html', data)
+        message_html = render_to_string(
+            'ticketing/mail/tickets.html', data)
+    email = EmailMultiAlternatives(
+        subject, message_plain,
+        from_email=SENDER,
+        to=[order.email],
+        cc=[settings.EMAIL_WEBTEAM, settings.EMAIL_BESTUUR],
+    )
+    email.attach_alternative(message_html, "text/html")
+    return email
+
+
+def queue_tickets_mails(orders):
+    """
+    Queue the tickets of many payed orders.
+
+    The orders should come with their performance and tickets prefetched.
+    The PDFs are rendered by the mail worker.
+    """
+    mails = []
+    for order in orders:
+        mail = _outgoing_mail(tickets_email(order, tickets_data(order)),
+                              order)
+        mail.attach_tickets = True
+        mails.append(mail)
+    return OutgoingMail.objects.bulk_create(mails)
+
+
+def _to_message(mail: OutgoingMail, mail_connection):
+    """Rebuild the message of a stored mail."""
+    email = EmailMultiAlternatives(
+        mail.subject, mail.body,
+        from_email=mail.sender,
+        to=mail.to.split(),
+        cc=mail.cc.split(),
+        connection=mail_connection,
+    )
+    if mail.html_body:
+        email.attach_alternative(mail.html_body, "text/html")
+    if mail.attachment is not None:
+        email.attach(mail.attachment_name, bytes(mail.attachment),
+                     mail.attachment_type)
+    return email
+
+
+def pending_mails():
+    """Mails that are due for (another) delivery attempt."""
+    return OutgoingMail.objects.filter(
+        sent=None, attempts__lt=_max_attempts(), next_attempt__lte=now(),
+    ).order_by('next_attempt', 'id')
+
+
+def _orders_with_tickets():
+    return OnlineOrder.objects.select_related(
+        'performance__production', 'performance__location')
+
+
+def render_missing_tickets(batch_size: int = 50, workers: int = None):
+    """Render the missing PDFs of the next mails in parallel."""
+    order_ids = list(pending_mails().filter(
+        attach_tickets=True, attachment__isnull=True,
+        order__isnull=False).values_list('order_id', flat=True)[:batch_size])
+    missing = [order.id for order in _orders_with_tickets().filter(
+        id__in=order_ids) if not default_storage.exists(
+        tickets_pdf_name(order))]
+    # A single PDF is rendered on delivery
+    if len(missing) > 1:
+        for order_id, error in render_orders(missing, workers):
+            if error:
+                log.error("Tickets of order %s couldn't be rendered: %s",
+                          order_id, error)
+
+
+def _attach_tickets(mail: OutgoingMail):
+    """Attach the stored tickets of the order of a mail."""
+    if mail.order_id is None:
+        raise ValueError("The order of the tickets was removed.")
+    with open_tickets_pdf(_orders_with_tickets().get(
+            id=mail.order_id)) as pdf_file:
+        mail.attachment = pdf_file.read()
+    mail.attachment_name = 'tickets.pdf'
+    mail.attachment_type = 'application/pdf'
+
+
+def deliver_queued(batch_size: int = 50, workers: int = None):
+    """
+    Deliver one batch of the outbox.
+
+    The batch is locked while it is sent, so several workers can drain the
+    outbox side by side. Tickets are rendered before, over ``workers``
+    processes (0 renders them one by one on delivery). Returns the number
+    of sent and failed mails.
+    """
+    sent = failed = 0
+    if workers != 0:
+        # Outside the transaction, the rendering processes need their own
+        # database connections.
+        render_missing_tickets(batch_size, workers)
+    with transaction.atomic():
+        mails = pending_mails()
+        if connection.features.has_select_for_update_skip_locked:
+            mails = mails.select_for_update(skip_locked=True)
+        mails = list(mails[:batch_size])
+        if not mails:
+            return sent, failed
+
+        mail_connection = get_connection()
+        try:
+            mail_connection.open()
+            connect_error = None
+        except Exception as e:
+            connect_error = "Could not connect: %s" % e
+
+        for mail in mails:
+            mail.attempts += 1
+            try:
+                if connect_error:
+                    raise ConnectionError(connect_error)
+                if mail.attach_tickets and mail.attachment is None:
+                    _attach_tickets(mail)
+                with timed('deliver_mail'):
+                    _to_message(mail, mail_connection).send()
+            except Exception as e:
+                failed += 1
+                mail.last_error = str(e)
+                mail.next_attempt = now() + _retry_delay(mail.attempts)
+                log.error("Mail couldn't be send for order: %s (attempt %d)",
+                          mail.order_id, mail.attempts)
+            else:
+                sent += 1
+                mail.sent = now()
+                mail.last_error = ''
+
+        if connect_error is None:
+            mail_connection.close()
+        OutgoingMail.objects.bulk_update(
+            mails, ['attempts', 'sent', 'next_attempt', 'last_error'])
+
+    return sent, failed
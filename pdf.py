@@ -0,0 +1,236 @@
+"""
+Ticket PDFs.
+
+Rendering the tickets through WeasyPrint is expensive, so the PDF is
+rendered once (when the order is payed) and kept in the default storage.
+The file name is derived from the order, its tickets, the language, what
+is printed of its performance and the QR key, so a changed or moved order,
+an edited performance or a rotated key never gets served a stale PDF.
+
+WeasyPrint is single threaded, bulk jobs use ``render_orders`` to spread
+the work over a pool of processes.
+
+Static and media files referenced by the template are read straight from
+disk by ``url_fetcher`` (and kept in memory), so a render never makes an
+HTTP request to our own site and works without a request object. Any
+other url is still fetched over the network, with a warning in the log.
+"""
+
+import logging
+import mimetypes
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from hashlib import sha256
+from urllib.parse import urljoin, urlsplit
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.db import connections
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.template.loader import get_template
+from django.utils import translation
+from django.utils._os import safe_join
+from weasyprint import HTML, CSS, default_url_fetcher
+from weasyprint.text.fonts import FontConfiguration
+from .metrics import timed
+from .models import OnlineOrder, qr_key
+
+PDF_DIRECTORY = 'tickets'
+
+# Fonts and images loaded once per process, images only in worker processes
+_font_config = None
+_image_cache = None
+
+log = logging.getLogger(__name__)
+
+
+def default_base_url():
+    """Base url to resolve the urls in the tickets template."""
+    return getattr(settings, 'TICKETING_BASE_URL',
+                   'https://alumniarenbergorkest.be/')
+
+
+def _fonts():
+    global _font_config
+    if _font_config is None:
+        _font_config = FontConfiguration()
+    return _font_config
+
+
+def _local_path(url: str):
+    """Path on disk of one of our static or media urls, None otherwise."""
+    parts = urlsplit(url)
+    if parts.netloc and parts.netloc != urlsplit(default_base_url()).netloc:
+        return None
+
+    static_prefix = urlsplit(settings.STATIC_URL or '').path
+    media_prefix = urlsplit(settings.MEDIA_URL or '').path
+    try:
+        if static_prefix and parts.path.startswith(static_prefix):
+            name = parts.path[len(static_prefix):]
+            if settings.STATIC_ROOT:
+                path = safe_join(settings.STATIC_ROOT, name)
+                if os.path.isfile(path):
+                    return path
+            return finders.find(name)
+        if media_prefix and parts.path.startswith(media_prefix):
+            path = safe_join(settings.MEDIA_ROOT, parts.path[
+                len(media_prefix):])
+            return path if os.path.isfile(path) else None
+    except Exception:
+        return None
+    return None
+
+
+@lru_cache(maxsize=64)
+def _read_file(path: str, mtime: float):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def url_fetcher(url: str, *args, **kwargs):
+    """Fetch static and media files from disk, anything else as usual."""
+    path = _local_path(url)
+    if path is None:
+        if not url.startswith('data:'):
+            log.warning("Fetching %s for a ticket PDF, it is not a static "
+                        "or media file on disk.", url)
+        return default_url_fetcher(url, *args, **kwargs)
+    return {
+        'string': _read_file(path, os.path.getmtime(path)),
+        'mime_type': mimetypes.guess_type(path)[0],
+        'filename': os.path.basename(path),
+        'redirected_url': url,
+    }
+
+
+@lru_cache(maxsize=1)
+def _stylesheets():
+    """Parsed stylesheets of TICKETING_PDF_STYLESHEETS (static paths)."""
+    return [
+        CSS(url=urljoin(default_base_url(), settings.STATIC_URL + name),
+            url_fetcher=url_fetcher, font_config=_fonts())
+        for name in getattr(settings, 'TICKETING_PDF_STYLESHEETS', ())
+    ]
+
+
+def tickets_data(order: OnlineOrder):
+    """Template data for the tickets of an order."""
+    ticket_info = []
+    for ticket in order.tickets.all():
+        ticket_info.append((str(ticket.price_category), ticket.qr_code))
+
+    return {
+        'order_id': order.id,
+        'tickets': ticket_info,
+        'first_name': order.first_name,
+        'last_name': order.last_name,
+        'performance': order.performance,
+        'payment': order.payment_method,
+        'production_name': order.performance.production.name,
+        'location': order.performance.location,
+        'address': order.performance.location.address,
+        'date': order.performance.date.date(),
+        'time': order.performance.date.time(),
+    }
+
+
+def render_tickets_pdf(order: OnlineOrder):
+    """Render the tickets of an order, returns the data and the pdf."""
+    with timed('render_tickets_pdf'), translation.override(order.language):
+        data = tickets_data(order)
+        html_template = get_template('ticketing/mail/tickets_pdf.html')
+        pdf_file = HTML(
+            string=html_template.render(data),
+            base_url=default_base_url(), url_fetcher=url_fetcher,
+        ).write_pdf(stylesheets=_stylesheets(), font_config=_fonts(),
+                    image_cache=_image_cache)
+    return data, pdf_file
+
+
+def _order_directory(order_id: int):
+    return '%s/%d' % (PDF_DIRECTORY, order_id)
+
+
+def tickets_pdf_name(order: OnlineOrder):
+    """Storage name of the PDF for the current tickets of an order."""
+    tickets = order.tickets.order_by('id').values_list(
+        'id', 'code', 'price_category_id')
+    performance = order.performance
+    location = performance.location
+    key = sha256('{}:{}:{}:{}:{}:{}:{}:{}:{}'.format(
+        order.id, order.language, list(tickets), performance.id,
+        performance.date.isoformat(), performance.production.name,
+        location.id, location.name, location.address,
+    ).encode())
+    # The signed codes in the QR codes change with the key
+    key.update(sha256(qr_key().encode()).digest())
+    key = key.hexdigest()
+    return '%s/%s.pdf' % (_order_directory(order.id), key[:32])
+
+
+def invalidate_tickets_pdf(order_id: int, keep: str = None):
+    """Remove the stored PDFs of an order."""
+    directory = _order_directory(order_id)
+    try:
+        files = default_storage.listdir(directory)[1]
+    except FileNotFoundError:
+        return
+    for name in files:
+        path = '%s/%s' % (directory, name)
+        if path != keep:
+            default_storage.delete(path)
+
+
+def store_tickets_pdf(order: OnlineOrder):
+    """Render the tickets of an order and keep them in storage."""
+    name = tickets_pdf_name(order)
+    data, pdf_file = render_tickets_pdf(order)
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    default_storage.save(name, ContentFile(pdf_file))
+    invalidate_tickets_pdf(order.id, keep=name)
+    return data, pdf_file
+
+
+def open_tickets_pdf(order: OnlineOrder):
+    """Open the stored tickets of an order, rendering them on a miss."""
+    name = tickets_pdf_name(order)
+    if not default_storage.exists(name):
+        store_tickets_pdf(order)
+    return default_storage.open(name)
+
+
+def _init_worker():
+    """Prepare a rendering process."""
+    global _image_cache
+    import django
+    django.setup()
+    _image_cache = {}
+
+
+def _render_order(order_id: int):
+    """Render and store the tickets of one order in a worker process."""
+    try:
+        order = OnlineOrder.objects.select_related(
+            'performance__production', 'performance__location',
+        ).get(id=order_id)
+        store_tickets_pdf(order)
+    except Exception as e:
+        return order_id, str(e) or e.__class__.__name__
+    return order_id, None
+
+
+def render_orders(order_ids, workers: int = None):
+    """
+    Render and store the tickets of many orders in parallel.
+
+    Yields ``(order_id, error)`` as orders finish, the error is None when
+    the tickets were stored.
+    """
+    # Every process has to open its own database connection
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker) as pool:
+        yield from pool.map(_render_order, order_ids, chunksize=4)
@@ -0,0 +1,189 @@
+"""
+Log of the scans at the door.
+
+Every scan is recorded as a ``ScanEvent``. To keep a scan at one write,
+events are buffered per process and inserted with one ``bulk_create`` once
+``TICKETING_SCAN_LOG_SIZE`` events are waiting or the oldest one is
+``TICKETING_SCAN_LOG_AGE`` seconds old (by a timer thread, also in an idle
+worker), and when the process exits. Events still in the buffer when a
+process is killed are lost, the ``used`` flag of the tickets stays the
+reference for entrance.
+
+The reports count the scans per minute and gate, and the tickets that
+were scanned more than once.
+"""
+
+import atexit
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Min, Max, Q
+from django.db.models.functions import TruncMinute
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import now
+from .models import Performance, ScanEvent
+from .scanning import ScanResult, ScanStatus
+
+log = logging.getLogger(__name__)
+
+
+class ScanLog:
+    """Buffer of scan events, written in bulk."""
+
+    def __init__(self):
+        """Start with an empty buffer."""
+        self._lock = threading.Lock()
+        self._events = []
+        self._oldest = None
+        self._timer = None
+
+    @staticmethod
+    def max_size():
+        """Events kept before writing them."""
+        return getattr(settings, 'TICKETING_SCAN_LOG_SIZE', 50)
+
+    @staticmethod
+    def max_age():
+        """Seconds an event is kept before writing it."""
+        return getattr(settings, 'TICKETING_SCAN_LOG_AGE', 5)
+
+    def add(self, events):
+        """Buffer events, writing the buffer when it is full or old."""
+        with self._lock:
+            if not self._events:
+                self._oldest = time.monotonic()
+                self._timer = threading.Timer(self.max_age(),
+                                              self._flush_old)
+                self._timer.daemon = True
+                self._timer.start()
+            self._events.extend(events)
+            if (len(self._events) < self.max_size()
+                    and time.monotonic() - self._oldest < self.max_age()):
+                return
+            events = self._take()
+        self._write(events)
+
+    def flush(self):
+        """Write all buffered events."""
+        with self._lock:
+            events = self._take()
+        self._write(events)
+
+    def clear(self):
+        """Drop the buffered events, e.g. of a rolled back transaction."""
+        with self._lock:
+            self._take()
+
+    def _take(self):
+        """Empty the buffer, returns its events."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        events, self._events = self._events, []
+        return events
+
+    def _flush_old(self):
+        """Write the buffer from the timer thread, with its own connection."""
+        try:
+            self.flush()
+        finally:
+            connection.close()
+
+    def _write(self, events):
+        if not events:
+            return
+        try:
+            ScanEvent.objects.bulk_create(events)
+        except Exception:
+            log.exception("Lost %d scan events.", len(events))
+
+
+scan_log = ScanLog()
+atexit.register(scan_log.flush)
+
+
+def scan_event(result: ScanResult, gate: str = '', performance: int = None,
+               scanned_at=None):
+    """Event of a scan."""
+    if result.ticket is not None:
+        performance = result.ticket.order.performance_id
+    return ScanEvent(
+        ticket=result.ticket,
+        performance_id=performance,
+        gate=gate[:50],
+        scanned_at=scanned_at or now(),
+        status=result.status.value,
+    )
+
+
+def record_scans(results, gate: str = '', performance: int = None):
+    """Log the results of scans at a gate."""
+    scan_log.add([scan_event(result, gate, performance)
+                  for result in results])
+
+
+def _offline_event(performance: Performance, scan: dict, status: ScanStatus):
+    try:
+        scanned_at = parse_datetime(str(scan.get('scanned_at') or ''))
+    except ValueError:
+        scanned_at = None
+    ticket = scan.get('id')
+    return ScanEvent(
+        ticket_id=ticket if (status != ScanStatus.INVALID
+                             and isinstance(ticket, int)) else None,
+        performance=performance,
+        gate=str(scan.get('gate') or '')[:50],
+        scanned_at=scanned_at or now(),
+        status=status.value,
+    )
+
+
+def record_offline_scans(performance: Performance, scans, outcome: dict):
+    """
+    Log the scans a device recorded offline, with their gate and time.
+
+    ``outcome`` is the result of ``apply_offline_scans`` for ``scans``,
+    the events are written at once.
+    """
+    invalid = {id(scan) for scan in outcome['invalid']}
+    applied = set(outcome['applied'])
+    events = [_offline_event(performance, scan, ScanStatus.INVALID)
+              for scan in outcome['invalid']]
+    events += [_offline_event(performance, scan, ScanStatus.ALREADY_SCANNED)
+               for scan in outcome['conflicts']]
+    # The first scan of an applied ticket is the one that let it in
+    for scan in sorted(scans, key=lambda scan: str(scan.get('scanned_at',
+                                                            ''))):
+        if id(scan) not in invalid and scan.get('id') in applied:
+            applied.discard(scan.get('id'))
+            events.append(_offline_event(performance, scan,
+                                         ScanStatus.VALID))
+    ScanEvent.objects.bulk_create(events)
+
+
+def scans_per_minute(performance: Performance):
+    """Number of scans per minute and gate, in time order."""
+    return ScanEvent.objects.filter(performance=performance).annotate(
+        minute=TruncMinute('scanned_at')).values('minute', 'gate').annotate(
+        scans=Count('id'),
+        valid=Count('id', filter=Q(status=ScanStatus.VALID.value)),
+    ).order_by('minute', 'gate')
+
+
+def duplicate_scans(performance: Performance):
+    """Tickets scanned more than once, with the number of scans."""
+    return ScanEvent.objects.filter(
+        performance=performance, ticket__isnull=False).values(
+        'ticket').annotate(
+        scans=Count('id'), gates=Count('gate', distinct=True),
+        first=Min('scanned_at'), last=Max('scanned_at'),
+    ).filter(scans__gt=1).order_by('-scans', 'ticket')
+
+
+def gate_totals(performance: Performance):
+    """Number of scans per gate and status."""
+    return ScanEvent.objects.filter(performance=performance).values(
+        'gate', 'status').annotate(scans=Count('id')).order_by(
+        'gate', 'status')
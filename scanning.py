@@ -0,0 +1,355 @@
+"""
+Ticket scanning at the door.
+
+A scan is resolved with a single query and a ticket is marked as used
+with a conditional update, so when two gates scan the same ticket at the
+same time exactly one of them gets a valid scan.
+
+Door-check devices can also work offline: they download a manifest of all
+tickets of a performance before the doors open, validate scans against it
+and push the scans they recorded back with ``apply_offline_scans``.
+
+Tickets carry a signed code (``v2-<performance>-<tag>-<signature>``),
+forged codes and codes of another performance are rejected before the
+database is queried. The tag follows the stored code of the ticket, the
+lookup rejects codes printed before it changed. The plain codes of older
+tickets keep working.
+"""
+
+import gzip
+import json
+from enum import Enum
+from hashlib import sha256
+from typing import NamedTuple
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.utils.crypto import constant_time_compare
+from django.utils.timezone import now, localdate, localtime
+from .models import Performance, Ticket, SIGNED_CODE_PREFIX, sign_code, \
+    signed_code
+
+MANIFEST_FORMAT = 2
+
+
+class ScanStatus(Enum):
+    """Outcome of a scan."""
+
+    VALID = 'valid'
+    ALREADY_SCANNED = 'already_scanned'
+    WRONG_DAY = 'wrong_day'
+    WRONG_PERFORMANCE = 'wrong_performance'
+    CASH_TICKET = 'cash_ticket'
+    INVALID = 'invalid'
+    UNKNOWN = 'unknown'
+
+
+class ScanResult(NamedTuple):
+    """A scan with the ticket it resolved to."""
+
+    status: ScanStatus
+    code: str
+    ticket: Ticket = None
+    error: str = ''
+
+    @property
+    def valid(self):
+        """The ticket grants entrance (or did so before)."""
+        return self.status in (ScanStatus.VALID, ScanStatus.ALREADY_SCANNED,
+                               ScanStatus.CASH_TICKET)
+
+    @property
+    def already_scanned(self):
+        """The ticket was used before this scan."""
+        return (self.status == ScanStatus.ALREADY_SCANNED
+                or (self.status in (ScanStatus.WRONG_DAY,
+                                    ScanStatus.WRONG_PERFORMANCE)
+                    and self.ticket is not None and self.ticket.used))
+
+    @property
+    def message(self):
+        """Text shown on the scanner."""
+        if self.status == ScanStatus.UNKNOWN:
+            return ("Unknown (%s) %s" % (self.code, self.error)).strip()
+        if self.status == ScanStatus.INVALID:
+            return "Ticket is invalid!"
+        if self.status == ScanStatus.CASH_TICKET:
+            return "KASSA TICKET!"
+        if self.status == ScanStatus.WRONG_PERFORMANCE and not self.ticket:
+            return "WRONG CONCERT!"
+
+        ticket = self.ticket
+        try:
+            holder = "%s, %s" % (ticket.order.onlineorder.last_name,
+                                 ticket.order.onlineorder.first_name)
+        except ObjectDoesNotExist:
+            holder = "??"
+        message = "%s - %s (%d)" % (holder, ticket.price_category.name,
+                                    ticket.id)
+        if self.status in (ScanStatus.WRONG_DAY,
+                           ScanStatus.WRONG_PERFORMANCE):
+            performance = ticket.order.performance
+            message += " WRONG %s - Ticket for concert %s on %s" % (
+                "DAY" if self.status == ScanStatus.WRONG_DAY else "CONCERT",
+                performance, performance.date.strftime("%a %d/%m/%y"))
+            if ticket.used:
+                message += " AND SCANNED!"
+        return message
+
+    def as_json(self):
+        """Reply for the scanner."""
+        return {
+            "status": self.status.value,
+            "valid": self.valid,
+            "already_scanned": self.already_scanned,
+            "text": self.message,
+        }
+
+
+def parse_code(code: str):
+    """Split the url of a QR code in the ticket id and its code."""
+    items = code.split("/")
+    if len(items[-1]) > 3:
+        id, hash_code = items[-2], items[-1]
+    else:
+        id, hash_code = items[-3], items[-2]
+    return int(id), hash_code
+
+
+def precheck(id: int, hash_code: str, performance: int = None):
+    """
+    Verdict on a signed code without the database.
+
+    Returns INVALID for forged codes, WRONG_PERFORMANCE for codes of
+    another performance than ``performance``, None when the ticket has to
+    be looked up (also for plain codes).
+    """
+    if not hash_code.startswith(SIGNED_CODE_PREFIX):
+        return None
+    try:
+        signed_performance, tag = hash_code.split('-')[1:3]
+        signed_performance = int(signed_performance)
+    except ValueError:
+        return ScanStatus.INVALID
+    if not constant_time_compare(hash_code,
+                                 sign_code(id, signed_performance, tag)):
+        return ScanStatus.INVALID
+    if performance is not None and signed_performance != performance:
+        return ScanStatus.WRONG_PERFORMANCE
+    return None
+
+
+def _scan_queryset():
+    return Ticket.objects.select_related(
+        'price_category', 'order__onlineorder',
+        'order__performance__production', 'order__performance__location')
+
+
+def _verdict(ticket: Ticket, hash_code: str, performance: int = None):
+    """Status of a scan, without marking the ticket."""
+    if hash_code != ticket.code and hash_code != ticket.scan_code:
+        return ScanStatus.INVALID
+    if "kassaticket" in ticket.code:
+        return ScanStatus.CASH_TICKET
+    if performance is not None and ticket.order.performance_id != performance:
+        return ScanStatus.WRONG_PERFORMANCE
+    if localtime(ticket.order.performance.date).date() != localdate():
+        return ScanStatus.WRONG_DAY
+    if ticket.used:
+        return ScanStatus.ALREADY_SCANNED
+    return ScanStatus.VALID
+
+
+def scan_ticket(code: str, performance: int = None):
+    """
+    Scan the url of a QR code, at the door of ``performance`` if given.
+
+    Takes one query to find the ticket, and one conditional update to mark
+    a valid ticket as used. Forged signed codes take none.
+    """
+    try:
+        id, hash_code = parse_code(code)
+    except (ValueError, IndexError) as e:
+        return ScanResult(ScanStatus.UNKNOWN, code, error=str(e))
+
+    status = precheck(id, hash_code, performance)
+    if status is not None:
+        return ScanResult(status, code)
+    try:
+        ticket = _scan_queryset().get(id=id)
+    except Ticket.DoesNotExist as e:
+        return ScanResult(ScanStatus.UNKNOWN, code, error=str(e))
+
+    status = _verdict(ticket, hash_code, performance)
+    if status == ScanStatus.VALID:
+        if not Ticket.objects.filter(id=ticket.id, used=False).update(
+                used=True):
+            # Another gate was first
+            ticket.used = True
+            status = ScanStatus.ALREADY_SCANNED
+    return ScanResult(status, code, ticket)
+
+
+def scan_tickets(codes, performance: int = None):
+    """
+    Scan a batch of QR code urls, e.g. buffered by a scanner.
+
+    All tickets are fetched with one query, and the valid unused ones are
+    marked with one update. Returns a result per code, in the same order.
+    A ticket scanned twice in one batch is only valid the first time.
+    """
+    parsed = {}
+    prechecked = {}
+    for code in codes:
+        try:
+            parsed[code] = parse_code(code)
+        except (ValueError, IndexError) as e:
+            parsed[code] = e
+            continue
+        status = precheck(*parsed[code], performance)
+        if status is not None:
+            prechecked[code] = status
+
+    ids = [item[0] for code, item in parsed.items()
+           if isinstance(item, tuple) and code not in prechecked]
+    with transaction.atomic():
+        tickets = _scan_queryset().in_bulk(ids)
+        verdicts = {}
+        for code, item in parsed.items():
+            if isinstance(item, tuple) and item[0] in tickets:
+                verdicts[code] = _verdict(tickets[item[0]], item[1],
+                                          performance)
+
+        # Lock the unused tickets, scans at other gates may have won
+        candidates = {parsed[code][0] for code, status in verdicts.items()
+                      if status == ScanStatus.VALID}
+        winners = set(Ticket.objects.select_for_update().filter(
+            id__in=candidates, used=False).values_list('id', flat=True))
+        Ticket.objects.filter(id__in=winners).update(used=True)
+
+    results = []
+    marked = set()
+    for code in codes:
+        item = parsed[code]
+        if not isinstance(item, tuple):
+            results.append(ScanResult(ScanStatus.UNKNOWN, code,
+                                      error=str(item)))
+            continue
+        if code in prechecked:
+            results.append(ScanResult(prechecked[code], code))
+            continue
+        ticket = tickets.get(item[0])
+        if ticket is None:
+            results.append(ScanResult(ScanStatus.UNKNOWN, code,
+                                      error="Ticket does not exist."))
+            continue
+        status = verdicts[code]
+        if status == ScanStatus.VALID:
+            if ticket.id in winners and ticket.id not in marked:
+                marked.add(ticket.id)
+            else:
+                status = ScanStatus.ALREADY_SCANNED
+        results.append(ScanResult(status, code, ticket))
+    return results
+
+
+def code_hash(code: str):
+    """Short hash of a ticket code as used in the manifest."""
+    return sha256(code.encode()).hexdigest()[:16]
+
+
+def build_manifest(performance: Performance):
+    """
+    Manifest of all tickets of a performance.
+
+    Every ticket is listed as ``[id, code hash, category index, holder,
+    used, signed code hash]``, the first hash is for tickets printed with
+    the plain code. The version changes whenever one of the tickets does,
+    so devices can tell whether they have to download it again.
+    """
+    tickets = Ticket.objects.filter(
+        order__performance=performance).order_by('id').values_list(
+        'id', 'code', 'price_category__name', 'used',
+        'order__onlineorder__last_name', 'order__onlineorder__first_name')
+
+    categories = []
+    entries = []
+    for id, code, category, used, last_name, first_name in tickets:
+        if category not in categories:
+            categories.append(category)
+        holder = "%s, %s" % (last_name, first_name) if last_name else "??"
+        entries.append([id, code_hash(code), categories.index(category),
+                        holder, used,
+                        code_hash(signed_code(id, performance.id, code))])
+
+    version = sha256(json.dumps(
+        [categories, entries], separators=(',', ':')).encode()).hexdigest()
+    return {
+        'format': MANIFEST_FORMAT,
+        'version': version[:16],
+        'performance': performance.id,
+        'date': performance.date.isoformat(),
+        'generated': now().isoformat(),
+        'categories': categories,
+        'tickets': entries,
+    }
+
+
+def manifest_gzip(manifest: dict):
+    """Compact gzipped JSON of a manifest."""
+    return gzip.compress(
+        json.dumps(manifest, separators=(',', ':')).encode(), mtime=0)
+
+
+def is_offline_scan(scan):
+    """A scan pushed by a device is a dict with an int id and a str code."""
+    return (isinstance(scan, dict)
+            and isinstance(scan.get('id'), int)
+            and not isinstance(scan.get('id'), bool)
+            and isinstance(scan.get('code'), str))
+
+
+def apply_offline_scans(performance: Performance, scans):
+    """
+    Apply the scans a device recorded while offline.
+
+    ``scans`` is a list of dicts with the ``id`` and ``code`` of the
+    ticket and optionally the ``gate`` and ``scanned_at``, checked with
+    ``is_offline_scan`` before. All scans are
+    applied in one transaction. Tickets that were already used, or that
+    were scanned twice in the batch (e.g. at two gates), are reported as
+    conflicts. Unknown tickets are reported as invalid.
+    """
+    scans = sorted(scans, key=lambda scan: str(scan.get('scanned_at', '')))
+    applied, conflicts, invalid = [], [], []
+    with transaction.atomic():
+        tickets = {
+            ticket.id: ticket for ticket in Ticket.objects.filter(
+                order__performance=performance,
+                id__in=[scan.get('id') for scan in scans],
+            ).select_for_update().only('id', 'code', 'used')
+        }
+        first_scan = {}
+        for scan in scans:
+            ticket = tickets.get(scan.get('id'))
+            if ticket is None or scan.get('code') not in (
+                    ticket.code,
+                    signed_code(ticket.id, performance.id, ticket.code)):
+                invalid.append(scan)
+            elif ticket.id in first_scan:
+                conflicts.append(dict(scan, reason='double_entry',
+                                      first=first_scan[ticket.id]))
+            elif ticket.used:
+                first_scan[ticket.id] = scan
+                conflicts.append(dict(scan, reason='already_scanned'))
+            else:
+                first_scan[ticket.id] = scan
+                applied.append(ticket.id)
+
+        Ticket.objects.filter(id__in=applied).exclude(
+            code__contains="kassaticket").update(used=True)
+
+    return {
+        'applied': applied,
+        'conflicts': conflicts,
+        'invalid': invalid,
+    }
@@ -0,0 +1,111 @@
+"""Signal handlers keeping derived ticketing data up to date."""
+
+from django.contrib.auth import get_user_model
+from django.db.models import QuerySet
+from django.db.models.signals import pre_save, post_save, pre_delete, \
+    post_delete, m2m_changed
+from django.dispatch import receiver
+from .models import Location, PriceCategory, Production, Performance, \
+    Order, OnlineOrder, Ticket
+from .aggregates import record_sale, move_sale, remove_seller
+from .caching import invalidate_overview, invalidate_availability
+from .inventory import adjust_sold, move_sold
+from .pdf import invalidate_tickets_pdf
+
+# Orders being deleted, their tickets are accounted for once per order
+_deleted_orders = set()
+
+
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+@receiver(post_save, sender=PriceCategory)
+@receiver(post_delete, sender=PriceCategory)
+@receiver(post_save, sender=Production)
+@receiver(post_delete, sender=Production)
+@receiver(post_save, sender=Performance)
+@receiver(post_delete, sender=Performance)
+@receiver(m2m_changed, sender=Performance.price_categories.through)
+def sales_changed(sender, **kwargs):
+    """Drop the cached pages when productions or their sales change."""
+    invalidate_overview()
+    invalidate_availability()
+
+
+@receiver(pre_save, sender=Order)
+@receiver(pre_save, sender=OnlineOrder)
+def order_changing(sender, instance, raw=False, **kwargs):
+    """Remember where an edited order was counted."""
+    if not raw and not instance._state.adding:
+        instance._counted = Order.objects.filter(id=instance.id).values(
+            'performance_id', 'date', 'seller_id', 'ticket_count').first()
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_save, sender=OnlineOrder)
+def order_added(sender, instance, created, raw=False, **kwargs):
+    """Count a new order in the sales, move the sales of an edited one."""
+    counted = instance.__dict__.pop('_counted', None)
+    if raw:
+        return
+    if created:
+        # Orders placed online come with their (bulk created) tickets
+        record_sale(instance, orders=1, tickets=instance.ticket_count)
+    elif counted is not None:
+        if counted['performance_id'] != instance.performance_id:
+            move_sold(counted['performance_id'], instance.performance_id,
+                      counted['ticket_count'])
+        move_sale(counted, instance, counted['ticket_count'])
+
+
+def _performance_deleted(origin):
+    """The deletion started at a performance or production (Django 4.1+)."""
+    model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    return issubclass(model, (Performance, Production))
+
+
+@receiver(pre_delete, sender=Order)
+def order_removing(sender, instance, origin=None, **kwargs):
+    """Remove the order and all its tickets from the sales at once."""
+    _deleted_orders.add(instance.id)
+    if origin is not None and _performance_deleted(origin):
+        # The counters and aggregates are deleted with the performance
+        return
+    if instance.ticket_count:
+        adjust_sold(instance.id, -instance.ticket_count)
+    record_sale(instance, orders=-1, tickets=-instance.ticket_count)
+
+
+@receiver(post_delete, sender=Order)
+def order_removed(sender, instance, **kwargs):
+    """Clean up the tickets of a deleted order."""
+    _deleted_orders.discard(instance.id)
+    invalidate_tickets_pdf(instance.id)
+
+
+@receiver(pre_delete, sender=get_user_model())
+def seller_removing(sender, instance, **kwargs):
+    """Keep the sales of a deleted seller, as sales without seller."""
+    remove_seller(instance.id)
+
+
+@receiver(post_save, sender=Ticket)
+def ticket_added(sender, instance, created, raw=False, **kwargs):
+    """Count tickets added outside of the order flow (e.g. the admin)."""
+    if created and not raw:
+        adjust_sold(instance.order_id, 1)
+        record_sale(instance.order, tickets=1)
+        instance.order.update_totals()
+        invalidate_tickets_pdf(instance.order_id)
+
+
+@receiver(post_delete, sender=Ticket)
+def ticket_removed(sender, instance, **kwargs):
+    """Give the seat of a ticket deleted on its own back."""
+    if instance.order_id in _deleted_orders:
+        return
+    adjust_sold(instance.order_id, -1)
+    order = Order.objects.filter(id=instance.order_id).first()
+    if order is not None:
+        record_sale(order, tickets=-1)
+        order.update_totals()
+    invalidate_tickets_pdf(instance.order_id)
@@ -1,3 +1,901 @@
-from django.test import TestCase
+import json
+import tempfile
+from datetime import timedelta
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, connection, transaction
+from django.test import Client, TestCase, TransactionTestCase, \
+    override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.timezone import now
+from . import metrics, pdf, scanning, views, waiting_room
+from .admin import ActivePerformanceFilter
+from .aggregates import rebuild_aggregates
+from .bank import read_csv
+from .export import COLUMNS
+from .outbox import deliver_queued, queue_mail
+from .pdf import render_tickets_pdf
+from .scan_log import ScanLog
+from .inventory import SoldOut, expire_holds, hold_seats, reserve_seats
+from .models import Location, PriceCategory, Production, Performance, \
+    OnlineOrder, Order, OutgoingMail, SalesAggregate, ScanEvent, SeatHold, \
+    Ticket
+from .scanning import ScanStatus, parse_code, precheck, scan_ticket, \
+    scan_tickets
 
-# Create your tests here.
+
+def create_performance(seats=10, **kwargs):
+    """Performance open for sales in three days, with one price category."""
+    location = Location.objects.get_or_create(
+        name='Hall', defaults={'address': 'Street 1'})[0]
+    production = Production.objects.get_or_create(
+        name='Concert', defaults={'description': 'Music'})[0]
+    category = PriceCategory.objects.get_or_create(
+        name='Normal', defaults={'price': 10})[0]
+    performance = Performance.objects.create(**dict({
+        'production': production,
+        'location': location,
+        'date': now() + timedelta(days=3),
+        'seats': seats,
+        'open_sales': now() - timedelta(days=1),
+        'close_transfer_sales': now() + timedelta(days=1),
+        'close_sales': now() + timedelta(days=1),
+    }, **kwargs))
+    performance.price_categories.add(category)
+    return performance
+
+
+def create_tickets(performance, amount=1, **kwargs):
+    """Online order with ``amount`` tickets for a performance."""
+    order = OnlineOrder.objects.create(
+        performance=performance, date=now(), hash='order-%d' % (
+            Order.objects.count() + 1),
+        first_name='Ann', last_name='Smith', email='ann@example.com')
+    return [Ticket.objects.create(
+        order=order, price_category=performance.price_categories.get(),
+        **kwargs) for i in range(amount)]
+
+
+def qr_url(ticket, code=None):
+    """Url in the QR code of a ticket."""
+    return 'https://example.com/tickets/qr/info/%d/%s/' % (
+        ticket.id, code or ticket.scan_code)
+
+
+class PerformanceSaveTests(TestCase):
+    def test_stale_save_keeps_counters(self):
+        performance = create_performance()
+        stale = Performance.objects.get(id=performance.id)
+        reserve_seats(performance, 3)
+
+        stale.seats = 20
+        stale.save()
+        performance.refresh_from_db()
+        self.assertEqual(performance.seats, 20)
+        self.assertEqual(performance.tickets_sold, 3)
+
+    def test_new_performance_saves_counters(self):
+        performance = create_performance(tickets_sold=2, seats_held=1)
+        performance.refresh_from_db()
+        self.assertEqual(performance.tickets_sold, 2)
+        self.assertEqual(performance.seats_held, 1)
+
+
+class InventoryTests(TestCase):
+    def setUp(self):
+        self.performance = create_performance(seats=4)
+
+    def assertCounters(self, sold, held, performance=None):
+        performance = performance or self.performance
+        performance.refresh_from_db()
+        self.assertEqual((performance.tickets_sold, performance.seats_held),
+                         (sold, held))
+
+    def test_sold_out(self):
+        reserve_seats(self.performance, 3)
+        self.assertRaises(SoldOut, reserve_seats, self.performance, 2)
+        self.assertCounters(3, 0)
+        reserve_seats(self.performance, 1)
+        self.assertCounters(4, 0)
+        self.assertFalse(self.performance.active)
+
+    def test_hold_conversion(self):
+        hold = hold_seats(self.performance, 3)
+        self.assertCounters(0, 3)
+        self.assertRaises(SoldOut, hold_seats, self.performance, 2)
+        self.assertRaises(SoldOut, reserve_seats, self.performance, 2)
+
+        # Changing the hold replaces it
+        hold = hold_seats(self.performance, 2, hold.token)
+        self.assertCounters(0, 2)
+        reserve_seats(self.performance, 2, hold.token)
+        self.assertCounters(2, 0)
+        self.assertFalse(SeatHold.objects.exists())
+
+    def test_hold_of_another_performance(self):
+        other = create_performance()
+        hold = hold_seats(other, 2)
+        new = hold_seats(self.performance, 1, hold.token)
+        self.assertNotEqual(new.token, hold.token)
+        self.assertCounters(0, 1)
+        self.assertEqual(SeatHold.objects.count(), 2)
+        self.assertNotEqual(hold_seats(self.performance, 1, 'made-up').token,
+                            'made-up')
+
+    def test_hold_expiry(self):
+        hold_seats(self.performance, 3)
+        self.assertEqual(expire_holds(), 0)
+        SeatHold.objects.update(expires=now())
+        self.assertEqual(expire_holds(), 1)
+        self.assertCounters(0, 0)
+        reserve_seats(self.performance, 4)
+        self.assertCounters(4, 0)
+
+    def test_moved_order_moves_its_seats(self):
+        order = create_tickets(self.performance, 3)[0].order
+        other = create_performance()
+        order = OnlineOrder.objects.get(id=order.id)
+        order.performance = other
+        order.save()
+        self.assertCounters(0, 0)
+        self.assertCounters(3, 0, other)
+        order.remarks = 'Moved'
+        order.save()
+        self.assertCounters(3, 0, other)
+
+
+class OverviewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.performance = create_performance()
+
+    def performances(self):
+        response = self.client.get(reverse('tickets:overview'))
+        return [performance for production in response.context['data']
+                for performance in production['performances']]
+
+    def test_overview_is_cached(self):
+        self.performances()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.performances(), [self.performance])
+
+    def test_overview_follows_changes(self):
+        self.performances()
+        self.performance.seats = 20
+        self.performance.save()
+        performance, = self.performances()
+        self.assertEqual(performance.seats, 20)
+
+        location = Location.objects.get()
+        location.name = 'Aula'
+        location.save()
+        self.assertEqual(self.performances()[0].location.name, 'Aula')
+
+        category = PriceCategory.objects.create(name='Reduced', price=5)
+        self.performance.price_categories.add(category)
+        performance, = self.performances()
+        self.assertEqual(len(performance.price_categories.all()), 2)
+
+        production = Production.objects.get()
+        production.name = 'Gala'
+        production.save()
+        self.assertEqual(self.performances()[0].production.name, 'Gala')
+
+        production.active = False
+        production.save()
+        self.assertEqual(self.performances(), [])
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        get_user_model().objects.create_superuser(
+            'staff', 'staff@example.com', 'secret')
+
+    def test_views_are_recorded(self):
+        create_performance()
+        middleware = settings.MIDDLEWARE + [
+            metrics.MetricsMiddleware.__module__ + '.MetricsMiddleware']
+        with self.settings(TICKETING_METRICS=True, MIDDLEWARE=middleware):
+            client = Client()
+            cache.clear()
+            client.get(reverse('tickets:overview'))
+            client.login(username='staff', password='secret')
+            text = client.get(reverse('tickets:metrics')).content.decode()
+        self.assertIn('ticketing_calls_total{name="view:tickets:overview"} 1',
+                      text)
+        self.assertIn(
+            'ticketing_queries_total{name="view:tickets:overview"} 3', text)
+        self.assertIn(
+            'ticketing_errors_total{name="view:tickets:overview"} 0', text)
+
+    def test_disabled_metrics(self):
+        self.client.login(username='staff', password='secret')
+        self.assertEqual(self.client.get(reverse('tickets:metrics'))
+                         .status_code, 404)
+        with metrics.timed('disabled'):
+            pass
+        self.assertNotIn('disabled', metrics.prometheus_text())
+
+
+class AvailabilityTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.performance = create_performance(seats=5)
+
+    def remaining(self):
+        response = self.client.get(reverse('tickets:availability'))
+        return {performance['id']: performance['remaining']
+                for performance in response.json()['performances']}
+
+    def test_sales_are_written_through(self):
+        self.assertEqual(self.remaining(), {self.performance.id: 5})
+        with self.captureOnCommitCallbacks(execute=True):
+            reserve_seats(self.performance, 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            hold_seats(self.performance, 1)
+        # Served from the cache, without a query
+        with self.assertNumQueries(0):
+            self.assertEqual(self.remaining(), {self.performance.id: 2})
+
+    def test_sold_out_performance_is_dropped(self):
+        self.remaining()
+        with self.captureOnCommitCallbacks(execute=True):
+            reserve_seats(self.performance, 5)
+        self.assertEqual(self.remaining(), {})
+
+
+class OrderFormTests(TestCase):
+    def setUp(self):
+        self.performance = create_performance()
+        self.url = reverse('tickets:order', kwargs={'id': self.performance.id})
+
+    def submit(self, tickets=2, hash='order-form'):
+        return self.client.post(self.url, {
+            'first_name': 'Ann', 'last_name': 'Smith',
+            'email': 'ann@example.com', 'payment_method': 'transfer',
+            'first_concert': 'True', 'hash': hash, 'Normal': tickets,
+        })
+
+    def test_duplicate_submit_replays_confirmation(self):
+        first = self.submit()
+        with self.assertNumQueries(2):
+            again = self.submit()
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(Ticket.objects.count(), 2)
+        self.performance.refresh_from_db()
+        self.assertEqual(self.performance.tickets_sold, 2)
+        for key in ('order_id', 'order_hash', 'nr_of_tickets',
+                    'total_price'):
+            self.assertEqual(first.context[key], again.context[key])
+
+    def test_submit_to_another_performance_replays_confirmation(self):
+        first = self.submit()
+        other = create_performance()
+        self.url = reverse('tickets:order', kwargs={'id': other.id})
+        again = self.submit()
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(again.context['performance'], self.performance)
+        self.assertEqual(first.context['order_id'], again.context['order_id'])
+        other.refresh_from_db()
+        self.assertEqual(other.tickets_sold, 0)
+
+    def test_submit_queries(self):
+        self.submit()
+        # The form reads, the seats, the order, its sales and tickets, and
+        # the mail, each once
+        with self.assertNumQueries(11):
+            self.submit(hash='other-form')
+        sales = self.performance.sales.get()
+        self.assertEqual((sales.orders, sales.tickets), (2, 4))
+
+    def test_sold_out_order_is_refused(self):
+        self.submit(tickets=8)
+        response = self.submit(tickets=3, hash='other-form')
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertIn('tform', response.context)
+        self.assertTrue(response.context['tform'].non_field_errors())
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.performance = create_performance()
+
+    def submit(self):
+        return self.client.post(
+            reverse('tickets:order', kwargs={'id': self.performance.id}), {
+                'first_name': 'Ann', 'last_name': 'Smith',
+                'email': 'ann@example.com', 'payment_method': 'transfer',
+                'first_concert': 'True', 'hash': 'outbox', 'Normal': 1,
+            })
+
+    def test_mail_is_queued_with_the_order(self):
+        self.submit()
+        queued = OutgoingMail.objects.get()
+        self.assertEqual(queued.order, Order.objects.get())
+        self.assertEqual(queued.to, 'ann@example.com')
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_mail_is_dropped_with_the_order(self):
+        def queue_and_fail(*args):
+            queue_mail(*args)
+            raise RuntimeError("Order failed")
+
+        with mock.patch.object(views, 'queue_mail', queue_and_fail):
+            self.assertRaises(RuntimeError, self.submit)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OutgoingMail.objects.exists())
+
+    def test_worker_sends_queued_mail(self):
+        self.submit()
+        self.assertEqual(deliver_queued(workers=0), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['ann@example.com'])
+        self.assertIsNotNone(OutgoingMail.objects.get().sent)
+        self.assertEqual(deliver_queued(workers=0), (0, 0))
+
+    def test_failed_mail_is_retried(self):
+        self.submit()
+        with mock.patch('django.core.mail.EmailMessage.send',
+                        side_effect=OSError("Mail server down")):
+            self.assertEqual(deliver_queued(workers=0), (0, 1))
+        queued = OutgoingMail.objects.get()
+        self.assertEqual(queued.attempts, 1)
+        self.assertEqual(queued.last_error, "Mail server down")
+        self.assertIsNone(queued.sent)
+        self.assertGreater(queued.next_attempt, now())
+        # Not before the backoff has passed
+        self.assertEqual(deliver_queued(workers=0), (0, 0))
+
+        OutgoingMail.objects.update(next_attempt=now())
+        self.assertEqual(deliver_queued(workers=0), (1, 0))
+        queued.refresh_from_db()
+        self.assertIsNotNone(queued.sent)
+        self.assertEqual(queued.last_error, '')
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class TicketsPdfTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_root = self.settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.performance = create_performance(date=now())
+        self.ticket = create_tickets(self.performance)[0]
+        self.order = self.ticket.order
+        OnlineOrder.objects.filter(id=self.order.id).update(payed=True)
+        self.rendered = []
+
+    def download(self):
+        def render(order):
+            data, pdf_file = render_tickets_pdf(order)
+            self.rendered.append(data)
+            return data, pdf_file
+
+        order = OnlineOrder.objects.get(id=self.order.id)
+        with mock.patch.object(pdf, 'render_tickets_pdf', render), \
+                pdf.open_tickets_pdf(order) as pdf_file:
+            self.assertTrue(pdf_file.read().startswith(b'%PDF'))
+        return default_storage.listdir('tickets/%d' % self.order.id)[1]
+
+    def test_stored_pdf_is_reused(self):
+        stored = self.download()
+        self.assertEqual(self.download(), stored)
+        self.assertEqual(len(self.rendered), 1)
+
+    def test_moved_order_is_rendered_again(self):
+        self.download()
+        other = create_performance(date=now() + timedelta(days=10))
+        OnlineOrder.objects.filter(id=self.order.id).update(performance=other)
+        self.download()
+        self.assertEqual(len(self.rendered), 2)
+        self.assertEqual(self.rendered[1]['date'], other.date.date())
+
+    def test_edited_location_is_rendered_again(self):
+        self.download()
+        Location.objects.update(address='Street 2')
+        self.download()
+        self.assertEqual(self.rendered[1]['address'], 'Street 2')
+
+    def test_external_urls_are_logged(self):
+        with mock.patch.object(pdf, 'default_url_fetcher') as fetch, \
+                self.assertLogs(pdf.log, 'WARNING') as logs:
+            pdf.url_fetcher('https://fonts.example.com/font.woff')
+        fetch.assert_called_once_with('https://fonts.example.com/font.woff')
+        self.assertIn('fonts.example.com', logs.output[0])
+
+    def test_rotated_qr_key_is_rendered_again(self):
+        self.download()
+        with self.settings(TICKETING_QR_KEY='rotated'):
+            self.download()
+            printed = self.rendered[0]['tickets'][0][1]
+            reprinted = self.rendered[1]['tickets'][0][1]
+            self.assertNotEqual(printed, reprinted)
+            self.assertEqual(scan_ticket(printed).status, ScanStatus.INVALID)
+            self.assertEqual(scan_ticket(reprinted).status, ScanStatus.VALID)
+
+
+class OfflineSyncTests(TestCase):
+    def setUp(self):
+        self.performance = create_performance()
+        get_user_model().objects.create_superuser(
+            'staff', 'staff@example.com', 'secret')
+        self.client.login(username='staff', password='secret')
+
+    def sync(self, scans):
+        return self.client.post(
+            reverse('tickets:qr_sync', kwargs={'id': self.performance.id}),
+            json.dumps({'scans': scans}), content_type='application/json')
+
+    def test_malformed_scans_are_rejected(self):
+        for scans in ([1, 2], [{'id': [1], 'code': 'x'}],
+                      [{'id': 1, 'code': None}], [{'id': True, 'code': 'x'}],
+                      {'id': 1, 'code': 'x'}):
+            self.assertEqual(self.sync(scans).status_code, 400, scans)
+
+    def test_form_posts_are_rejected(self):
+        ticket, = create_tickets(self.performance)
+        response = self.client.post(
+            reverse('tickets:qr_sync', kwargs={'id': self.performance.id}),
+            {'scans': json.dumps([{'id': ticket.id, 'code': ticket.code}])})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ScanEvent.objects.exists())
+
+    def test_scan_times_of_devices(self):
+        ticket, = create_tickets(self.performance)
+        response = self.sync([
+            {'id': ticket.id, 'code': ticket.code, 'scanned_at': 5},
+            {'id': ticket.id, 'code': ticket.code, 'scanned_at': '2026-13-40'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ScanEvent.objects.count(), 2)
+
+    def test_unknown_scan_is_invalid(self):
+        response = self.sync([{'id': 999, 'code': 'abc'}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['invalid']), 1)
+
+
+class ScanningTests(TestCase):
+    def setUp(self):
+        self.performance = create_performance(date=now())
+        self.ticket, self.other = create_tickets(self.performance, 2)
+
+    def test_parse_code(self):
+        self.assertEqual(parse_code('https://x/qr/info/12/abcdef/'),
+                         (12, 'abcdef'))
+        self.assertEqual(parse_code('https://x/qr/info/12/abcdef'),
+                         (12, 'abcdef'))
+        self.assertRaises(ValueError, parse_code, 'https://x/info/ab/cdef/')
+        self.assertRaises(IndexError, parse_code, 'garbage')
+
+    def test_precheck(self):
+        code = self.ticket.scan_code
+        self.assertIsNone(precheck(self.ticket.id, code))
+        self.assertIsNone(precheck(self.ticket.id, code,
+                                   self.performance.id))
+        self.assertIsNone(precheck(self.ticket.id, self.ticket.code))
+        self.assertEqual(precheck(self.other.id, code), ScanStatus.INVALID)
+        self.assertEqual(precheck(self.ticket.id, code[:-1] + 'x'),
+                         ScanStatus.INVALID)
+        self.assertEqual(precheck(self.ticket.id, 'v2-x'),
+                         ScanStatus.INVALID)
+        self.assertEqual(precheck(self.ticket.id, code,
+                                  self.performance.id + 1),
+                         ScanStatus.WRONG_PERFORMANCE)
+
+    def test_verdict(self):
+        ticket = self.ticket
+        self.assertEqual(scanning._verdict(ticket, ticket.code),
+                         ScanStatus.VALID)
+        self.assertEqual(scanning._verdict(ticket, ticket.scan_code),
+                         ScanStatus.VALID)
+        self.assertEqual(scanning._verdict(ticket, self.other.code),
+                         ScanStatus.INVALID)
+        self.assertEqual(scanning._verdict(ticket, ticket.code,
+                                           self.performance.id + 1),
+                         ScanStatus.WRONG_PERFORMANCE)
+        ticket.used = True
+        self.assertEqual(scanning._verdict(ticket, ticket.code),
+                         ScanStatus.ALREADY_SCANNED)
+        Performance.objects.filter(id=self.performance.id).update(
+            date=now() + timedelta(days=2))
+        ticket = Ticket.objects.get(id=ticket.id)
+        self.assertEqual(scanning._verdict(ticket, ticket.code),
+                         ScanStatus.WRONG_DAY)
+
+    def test_cash_ticket(self):
+        ticket, = create_tickets(self.performance, code='kassaticket')
+        self.assertEqual(scanning._verdict(ticket, ticket.code),
+                         ScanStatus.CASH_TICKET)
+        self.assertTrue(scan_ticket(qr_url(ticket)).valid)
+        ticket.refresh_from_db()
+        self.assertFalse(ticket.used)
+
+    def test_scan_ticket(self):
+        with self.assertNumQueries(2):
+            result = scan_ticket(qr_url(self.ticket), self.performance.id)
+        self.assertEqual(result.status, ScanStatus.VALID)
+        self.assertEqual(result.ticket, self.ticket)
+        self.ticket.refresh_from_db()
+        self.assertTrue(self.ticket.used)
+
+        result = scan_ticket(qr_url(self.ticket))
+        self.assertEqual(result.status, ScanStatus.ALREADY_SCANNED)
+        self.assertTrue(result.already_scanned)
+        self.assertEqual(scan_ticket('garbage').status, ScanStatus.UNKNOWN)
+        self.assertEqual(scan_ticket(qr_url(self.ticket, 'abcdef')).status,
+                         ScanStatus.INVALID)
+
+    def test_scan_tickets(self):
+        used, = create_tickets(self.performance, used=True)
+        codes = [qr_url(self.ticket), qr_url(self.other),
+                 qr_url(self.ticket), qr_url(used), 'garbage',
+                 'https://x/qr/info/999999/abcdef/',
+                 qr_url(self.other, self.ticket.scan_code)]
+        statuses = [result.status for result in scan_tickets(codes)]
+        self.assertEqual(statuses, [
+            ScanStatus.VALID, ScanStatus.VALID, ScanStatus.ALREADY_SCANNED,
+            ScanStatus.ALREADY_SCANNED, ScanStatus.UNKNOWN,
+            ScanStatus.UNKNOWN, ScanStatus.INVALID,
+        ])
+        self.assertEqual(Ticket.objects.filter(used=True).count(), 3)
+
+    def test_scan_tickets_other_gate_first(self):
+        Ticket.objects.filter(id=self.ticket.id).update(used=True)
+        result, = scan_tickets([qr_url(self.ticket)], self.performance.id)
+        self.assertEqual(result.status, ScanStatus.ALREADY_SCANNED)
+
+    @override_settings(TICKETING_SCAN_BATCH_SIZE=2)
+    def test_batch_size_is_limited(self):
+        url = reverse('tickets:qr_reply_batch')
+        codes = [qr_url(self.ticket), qr_url(self.other)]
+        response = self.client.post(url, json.dumps({'codes': codes * 2}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Ticket.objects.filter(used=True).exists())
+        response = self.client.post(url, {'code': codes})
+        self.assertEqual(len(response.json()['results']), 2)
+
+    def test_new_code_revokes_printed_code(self):
+        printed = qr_url(self.ticket)
+        Ticket.objects.filter(id=self.ticket.id).update(code='newcode')
+        # Still correctly signed, the lookup rejects it
+        self.assertIsNone(precheck(*parse_code(printed)))
+        self.assertEqual(scan_ticket(printed).status, ScanStatus.INVALID)
+        self.ticket.refresh_from_db()
+        self.assertEqual(scan_ticket(qr_url(self.ticket)).status,
+                         ScanStatus.VALID)
+
+    def test_forged_code_takes_no_query(self):
+        with self.assertNumQueries(0):
+            result = scan_ticket(qr_url(self.other, self.ticket.scan_code))
+        self.assertEqual(result.status, ScanStatus.INVALID)
+
+    def test_only_one_gate_wins(self):
+        verdict = scanning._verdict
+
+        def other_gate_first(ticket, *args):
+            # Another gate marks the ticket between the lookup and the update
+            Ticket.objects.filter(id=ticket.id).update(used=True)
+            return verdict(ticket, *args)
+
+        with mock.patch.object(scanning, '_verdict', other_gate_first):
+            result = scan_ticket(qr_url(self.ticket))
+        self.assertEqual(result.status, ScanStatus.ALREADY_SCANNED)
+        self.assertTrue(result.ticket.used)
+
+
+class CsvExportTests(TestCase):
+    def setUp(self):
+        get_user_model().objects.create_superuser(
+            'staff', 'staff@example.com', 'secret')
+        self.client.login(username='staff', password='secret')
+        self.performance = create_performance()
+        self.url = reverse('tickets:csv', kwargs={'id': self.performance.id})
+
+    def export(self):
+        response = self.client.get(self.url)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode().splitlines()
+
+    def test_ticket_counts_per_category(self):
+        create_tickets(self.performance, 3)
+        create_tickets(self.performance, 1)
+        header, *rows = self.export()
+        self.assertEqual(header.split(';')[:3],
+                         ['voornaam', 'achternaam', 'NORMAL'])
+        self.assertEqual([row.split(';')[2] for row in rows], ['3', '1'])
+
+    def test_queries_do_not_grow_with_the_orders(self):
+        create_tickets(self.performance, 2)
+        with CaptureQueriesContext(connection) as few:
+            self.export()
+        for i in range(5):
+            create_tickets(self.performance, 2)
+        with self.assertNumQueries(len(few)):
+            self.assertEqual(len(self.export()), 7)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        get_user_model().objects.create_superuser(
+            'staff', 'staff@example.com', 'secret')
+        self.client.login(username='staff', password='secret')
+
+    def test_invalid_dates_are_refused(self):
+        url = reverse('tickets:export')
+        self.assertEqual(self.client.get(url, {'from': '17/10/2026'})
+                         .status_code, 400)
+        self.assertEqual(self.client.get(url, {'to': '2026-10'})
+                         .status_code, 400)
+        self.assertEqual(self.client.get(url, {'from': '2026-10-17'})
+                         .status_code, 200)
+        with self.assertRaises(CommandError):
+            call_command('export_orders', '--from', '17/10/2026')
+
+    def test_csv_rows(self):
+        performance = create_performance()
+        create_tickets(performance, 2)
+        response = self.client.get(reverse('tickets:export'),
+                                   {'production': performance.production_id})
+        header, *rows = b''.join(
+            response.streaming_content).decode().splitlines()
+        self.assertEqual(header.split(';'), COLUMNS)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0].split(';')[COLUMNS.index('price_category')],
+                         'Normal')
+
+
+class DeleteTests(TestCase):
+    def setUp(self):
+        self.performance = create_performance(seats=20)
+        self.tickets = create_tickets(self.performance, 10)
+        self.order = self.tickets[0].order
+        create_tickets(self.performance, 2)
+
+    def test_delete_order(self):
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.ticket_count, 10)
+        with self.assertNumQueries(7):
+            self.order.delete()
+        self.performance.refresh_from_db()
+        self.assertEqual(self.performance.tickets_sold, 2)
+        self.assertEqual(self.performance.sales.get().tickets, 2)
+        self.assertEqual(self.performance.sales.get().orders, 1)
+
+    def test_delete_ticket(self):
+        self.tickets[0].delete()
+        self.order.refresh_from_db()
+        self.performance.refresh_from_db()
+        self.assertEqual(self.order.ticket_count, 9)
+        self.assertEqual(self.performance.tickets_sold, 11)
+        self.assertEqual(self.performance.sales.get().tickets, 11)
+
+    def test_delete_performance(self):
+        self.performance.delete()
+        self.assertFalse(Ticket.objects.exists())
+        self.assertFalse(Order.objects.exists())
+
+
+class AggregateTests(TestCase):
+    def setUp(self):
+        self.performance = create_performance()
+
+    def sales(self):
+        return sorted(SalesAggregate.objects.values_list(
+            'performance_id', 'bucket', 'seller_id', 'orders', 'tickets'))
+
+    def test_one_row_per_hour_and_seller(self):
+        create_tickets(self.performance, 2)
+        create_tickets(self.performance, 3)
+        sales = self.performance.sales.get()
+        self.assertEqual((sales.orders, sales.tickets), (2, 5))
+        with transaction.atomic():
+            self.assertRaises(IntegrityError, SalesAggregate.objects.create,
+                              performance=self.performance,
+                              bucket=sales.bucket)
+
+    def test_moved_order_moves_its_sales(self):
+        order = create_tickets(self.performance, 2)[0].order
+        create_tickets(self.performance, 1)
+        order = OnlineOrder.objects.get(id=order.id)
+        order.performance = create_performance()
+        order.date = now() - timedelta(days=2)
+        order.save()
+        sales = self.sales()
+        self.assertEqual(len(sales), 2)
+        rebuild_aggregates()
+        self.assertEqual(self.sales(), sales)
+
+    def test_deleted_seller_keeps_sales(self):
+        seller = get_user_model().objects.create_user('seller')
+        create_tickets(self.performance, 2)
+        order = create_tickets(self.performance, 3)[0].order
+        Order.objects.filter(id=order.id).update(seller=seller)
+        rebuild_aggregates()
+        seller.delete()
+        sales = self.performance.sales.get()
+        self.assertEqual((sales.seller, sales.orders, sales.tickets),
+                         (None, 2, 5))
+
+
+class AdminFilterTests(TestCase):
+    def test_sold_out_performances_are_listed(self):
+        performance = create_performance(seats=2)
+        reserve_seats(performance, 2)
+        performance.refresh_from_db()
+        self.assertFalse(performance.active)
+
+        ended = create_performance(production=Production.objects.create(
+            name='Last season', description='Music', active=False))
+        performances = [id for id, name in ActivePerformanceFilter(
+            None, {}, Performance, None).lookups(None, None)]
+        self.assertIn(performance.id, performances)
+        self.assertNotIn(ended.id, performances)
+
+    def test_search_inside_names(self):
+        create_tickets(create_performance())
+        get_user_model().objects.create_superuser(
+            'staff', 'staff@example.com', 'secret')
+        self.client.login(username='staff', password='secret')
+        response = self.client.get(
+            reverse('admin:orchestra_season_onlineorder_changelist'),
+            {'q': 'mit'})
+        self.assertEqual(response.context['cl'].result_count, 1)
+
+
+class PayedActionTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_root = self.settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        get_user_model().objects.create_superuser(
+            'staff', 'staff@example.com', 'secret')
+        self.client.login(username='staff', password='secret')
+
+    def test_payed_orders_get_their_tickets(self):
+        performance = create_performance()
+        order = create_tickets(performance, 2)[0].order
+        payed = create_tickets(performance)[0].order
+        OnlineOrder.objects.filter(id=payed.id).update(payed=True)
+        response = self.client.post(
+            reverse('admin:orchestra_season_onlineorder_changelist'), {
+                'action': 'mark_payed_and_send',
+                '_selected_action': [order.id, payed.id],
+            }, follow=True)
+        self.assertIn('1 orders marked as payed',
+                      str(list(response.context['messages'])[0]))
+        self.assertEqual(OnlineOrder.objects.filter(payed=True).count(), 2)
+        queued = OutgoingMail.objects.get()
+        self.assertEqual((queued.order_id, queued.attach_tickets),
+                         (order.id, True))
+
+        self.assertEqual(deliver_queued(workers=0), (1, 0))
+        name, content, mimetype = mail.outbox[0].attachments[0]
+        self.assertEqual((name, mimetype), ('tickets.pdf', 'application/pdf'))
+        self.assertTrue(content.startswith(b'%PDF'))
+
+
+@override_settings(TICKETING_WAITING_ROOM_CAPACITY=1,
+                   TICKETING_WAITING_ROOM_CHECK_IN=30,
+                   TICKETING_WAITING_ROOM_TTL=600)
+class WaitingRoomTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        clock = mock.patch.object(waiting_room, 'time')
+        self.clock = clock.start()
+        self.addCleanup(clock.stop)
+
+    def position(self, number, at):
+        self.clock.time.return_value = at
+        return waiting_room.queue_position(1, number)
+
+    def join(self):
+        return waiting_room.join(1)[1]
+
+    def test_absent_buyer_loses_place_after_check_in(self):
+        first, second, third = self.join(), self.join(), self.join()
+        self.assertEqual(self.position(first, 1000), 0)
+        self.assertEqual(self.position(second, 1000), 1)
+        # The first buyer left, the second one closed their tab
+        self.assertEqual(self.position(third, 1601), 1)
+        self.assertEqual(self.position(third, 1632), 0)
+        self.assertIsNone(self.position(second, 1633))
+
+    def test_present_buyer_keeps_place(self):
+        first, second, third = self.join(), self.join(), self.join()
+        self.position(first, 1000)
+        self.assertEqual(self.position(third, 1601), 1)
+        self.assertEqual(self.position(second, 1610), 0)
+        self.assertEqual(self.position(third, 1632), 1)
+
+    def test_check_in_while_locked(self):
+        first, second = self.join(), self.join()
+        self.position(first, 1000)
+        self.position(second, 1601)
+        waiting_room._lock(1)
+        self.assertEqual(self.position(second, 1620), 0)
+        waiting_room._unlock(1)
+        self.assertEqual(self.position(second, 1640), 0)
+
+
+class BankStatementTests(TestCase):
+    def test_ragged_csv(self):
+        data = ('Datum;Bedrag;Mededeling;Naam tegenpartij\n'
+                '01/10/2026;20,00;Tickets Smith - 12;Ann Smith\n'
+                '02/10/2026;1.234,50;Tickets Doe - 13\n'
+                '03/10/2026;-5,00;Fee\n'
+                '04/10/2026;15,00\n'
+                '05/10/2026\n').encode()
+        transfers = list(read_csv(data))
+        self.assertEqual([(t.line, t.amount, t.name, t.order_id)
+                          for t in transfers], [
+            (2, 20.0, 'Ann Smith', 12),
+            (3, 1234.5, '', 13),
+            (5, 15.0, '', None),
+        ])
+
+    def test_reference_in_communication_columns(self):
+        data = ('Boekingsdatum;Bedrag;Mededeling 1;Mededeling 2;Valutadatum\n'
+                '01/10/2026;20,00;Tickets Smith;;01-10-2026\n'
+                '01/10/2026;20,00;Tickets;Smith - 12;01-10-2026\n').encode()
+        self.assertEqual([t.order_id for t in read_csv(data)], [None, 12])
+        data = (b'Datum;Bedrag;Info;Valutadatum\n'
+                b'01/10/2026;20,00;Tickets Smith;01-10-2026\n')
+        self.assertEqual([t.order_id for t in read_csv(data)], [None])
+
+    def test_comma_separated_csv(self):
+        data = (b'date,amount,name,message\n'
+                b'2026-10-01,"20.00",Ann,Tickets A - 5')
+        transfer, = read_csv(data)
+        self.assertEqual((transfer.amount, transfer.order_id), (20.0, 5))
+
+
+class ScanLogTests(TransactionTestCase):
+    def setUp(self):
+        self.performance = create_performance()
+
+    def event(self):
+        return ScanEvent(performance=self.performance, status='valid')
+
+    @override_settings(TICKETING_SCAN_LOG_SIZE=2,
+                       TICKETING_SCAN_LOG_AGE=60)
+    def test_full_buffer_is_written(self):
+        scan_log = ScanLog()
+        scan_log.add([self.event()])
+        self.assertEqual(ScanEvent.objects.count(), 0)
+        scan_log.add([self.event()])
+        self.assertEqual(ScanEvent.objects.count(), 2)
+        self.assertIsNone(scan_log._timer)
+
+    @override_settings(TICKETING_SCAN_LOG_AGE=0.05)
+    def test_old_events_are_written_without_new_scans(self):
+        scan_log = ScanLog()
+        scan_log.add([self.event()])
+        timer = scan_log._timer
+        timer.join(5)
+        self.assertEqual(ScanEvent.objects.count(), 1)
+
+    @override_settings(TICKETING_SCAN_LOG_AGE=0.05)
+    def test_cleared_events_are_dropped(self):
+        scan_log = ScanLog()
+        scan_log.add([self.event()])
+        timer = scan_log._timer
+        scan_log.clear()
+        timer.join(5)
+        scan_log.flush()
+        self.assertEqual(ScanEvent.objects.count(), 0)
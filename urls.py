@@ -1,12 +1,15 @@
 """Urls for user management."""
 
 from django.urls import path
-from . import views, view_stats
+from . import views, view_stats, waiting_room
 
 app_name = 'tickets'
 urlpatterns = [
     path('', views.overview, name='overview'),
+    path('availability/', views.availability, name='availability'),
     path('order/<int:id>/', views.order, name='order'),
+    path('order/<int:id>/queue/', waiting_room.queue_status, name='queue'),
+    path('order/<int:id>/hold/', views.hold, name='order_hold'),
     path('order/<int:id>/member/', views.order_paper, name='order_paper'),
     path(r'sold/<int:id>/', view_stats.stats_user, name='stats_user'),
     path(r'stats/', view_stats.stats, name='stats'),
@@ -14,7 +17,10 @@ urlpatterns = [
     # Scanning tickets
     path(r'qr/scan', views.qr_scan, name='qr_scan'),
     path(r'qr/reply', views.qr_reply, name='qr_reply'),
+    path(r'qr/reply/batch', views.qr_reply_batch, name='qr_reply_batch'),
     path(r'qr/info/<int:id>/<slug:code>/', views.qr_info, name='qr_info'),
+    path(r'qr/manifest/<int:id>/', views.qr_manifest, name='qr_manifest'),
+    path(r'qr/sync/<int:id>/', views.qr_sync, name='qr_sync'),
 
     # Set payed & send mail
     path(r'order/<int:id>/payed', views.send_order_payed, name='send_payed'),
@@ -28,4 +34,8 @@ urlpatterns = [
     path(r'test/<int:id>/qrmail', views.test_qr_mail, name='test_qr_mail'),
     # Export as CSV
     path(r'csv/<int:id>/', view_stats.csv_export, name='csv'),
+    path(r'export/', view_stats.export, name='export'),
+
+    # Instrumentation
+    path(r'metrics/', views.metrics, name='metrics'),
 ]
@@ -1,10 +1,14 @@
 from datetime import datetime
 import django.utils.timezone as django_tz
+from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required, user_passes_test
+from django.db.models import Count, Q, Sum
 from django.shortcuts import render
-from django.http import Http404, HttpResponse
-from .models import Production, Performance, OnlineOrder
-from io import StringIO
+from django.http import Http404, HttpResponseBadRequest, \
+    StreamingHttpResponse
+from .export import EXPORTERS, Echo, export_rows, select_orders, \
+    parse_bound
+from .models import Production, Performance, OnlineOrder, SalesAggregate
 import csv
 
 
@@ -33,56 +37,40 @@ def stats(request):
     """Stats for a performance."""
     graph_labels = []
     graph_datasets = []
-    performances = []
-    user_counts = {}
-
-    productions = Production.objects.filter(active=True).prefetch_related(
-        'performances__orders__tickets', 'performances__orders__seller')
-
-    for production in productions:
-        performances += list(production.performances.all())
-    performances = sorted(performances, key=lambda obj: obj.date)
-
-    # Getting ticket count for each of those performances, and the total count
-    performance_ticket_counts = []
     performance_info = []
 
-    for performance in performances:
-        performance_ticket_count = 0
-
-        for order in performance.orders.all():
-            performance_ticket_count += len(order.tickets.all())
-
-            # Getting user ranking
-            if order.seller:
-                if order.seller in user_counts:
-                    user_counts[order.seller] += len(order.tickets.all())
-                else:
-                    user_counts[order.seller] = len(order.tickets.all())
-
-        performance_ticket_counts.append(performance_ticket_count)
-        performance_info.append([performance.date.strftime(
-            '%d/%m'
-        ), performance_ticket_count, performance.date.strftime('%a')])
+    performances = Performance.objects.filter(
+        production__active=True).order_by('date')
+    sales = SalesAggregate.objects.filter(
+        performance__production__active=True).values(
+        'performance_id', 'bucket').annotate(
+        num_tickets=Sum('tickets')).order_by('bucket')
+    sales_per_performance = {}
+    for sale in sales:
+        sales_per_performance.setdefault(
+            sale['performance_id'], []).append(sale)
 
+    for performance in performances:
         # Getting graph data
+        performance_sales = sales_per_performance.get(performance.id, [])
         graph_dataset = []
         total_tickets = 0
-        orders = performance.orders.all()
-        orders = sorted(orders, key=lambda obj: obj.date)
-        if orders:
-            graph_start = to_timestamp(orders[0].date)
+        if performance_sales:
+            graph_start = to_timestamp(performance_sales[0]['bucket'])
         else:
             graph_start = to_timestamp(performance.date) - 5270400000
         graph_end = to_timestamp(performance.date)
-        for order in orders:
-            total_tickets += len(order.tickets.all())
+        for sale in performance_sales:
+            total_tickets += sale['num_tickets']
             graph_dataset.append({
-                'timestamp': to_timestamp(order.date),
-                'num_new_tickets': order.num_tickets,
+                'timestamp': to_timestamp(sale['bucket']),
+                'num_new_tickets': sale['num_tickets'],
                 'total_tickets': total_tickets,
-                'order': order,
             })
+
+        performance_info.append([performance.date.strftime(
+            '%d/%m'
+        ), total_tickets, performance.date.strftime('%a')])
         graph_datasets.append([
             performance.seats,
             performance.date.strftime('%a'),
@@ -91,10 +79,14 @@ def stats(request):
         graph_labels.append(performance.date.strftime('%a'))
 
     # Getting user ranking
-    user_ranks = []
-    for user in user_counts.keys():
-        user_ranks.append([str(user), user_counts[user]])
-    user_ranks = sorted(user_ranks, key=lambda user: -user[1])[0:20]
+    user_counts = SalesAggregate.objects.filter(
+        performance__production__active=True, seller__isnull=False).values(
+        'seller').annotate(num_tickets=Sum('tickets')).order_by(
+        '-num_tickets')[0:20]
+    users = get_user_model().objects.in_bulk(
+        [count['seller'] for count in user_counts])
+    user_ranks = [[str(users[count['seller']]), count['num_tickets']]
+                  for count in user_counts]
 
     # Render template and pass all processed data
     return render(request, 'ticketing/stats/total.html', {
@@ -113,46 +105,79 @@ def csv_export(request, id):
     except Exception:
         raise Http404
 
-    online_orders = OnlineOrder.objects.filter(performance__id=id).prefetch_related(
-        'performance__price_categories', 'tickets__price_category')
-    price_categories = performance.price_categories.all()
+    price_categories = list(performance.price_categories.all())
     price_categories_names_list = list(
         map(lambda c: str(c.name).upper(), price_categories))
+    # Ticket counts per category are computed by the database
+    category_counts = {
+        'category_%d' % c.id: Count('tickets', filter=Q(
+            tickets__price_category=c))
+        for c in price_categories
+    }
+    online_orders = OnlineOrder.objects.filter(
+        performance__id=id).select_related('seller').annotate(
+        **category_counts).order_by('id')
 
-    # create the list/matrix which is to be written in the csv file, and create the column titles
-    list_output = [['voornaam', 'achternaam'] + price_categories_names_list +
-                   ['totaaltickets', 'totaalprijs', 'betaalmethode', 'betaald',
-                    'eerste concert',
-                    'marketing feedback', 'verkoper',
-                    'opmerkingen', 'email']]
     bool_words = {
         True: "ja", False: "neen", None: "?"
     }
 
-    for online_order in online_orders:
-        next_row = [online_order.first_name, online_order.last_name]
-
-        # get count for sorts of tickets
-        category_count_dictionary = dict((c, 0) for c in price_categories)
-        for pricecategory in price_categories:
-            for ticket in online_order.tickets.all():
-                if ticket.price_category == pricecategory:
-                    category_count_dictionary[pricecategory] += 1
-        next_row += list(category_count_dictionary.values())
-        next_row += [online_order.num_tickets, online_order.total_price, online_order.payment_method,
-                     online_order.payed,
-                     bool_words.get(online_order.first_concert,
-                                    online_order.first_concert),
-                     online_order.marketing_feedback, online_order.seller,
-                     online_order.remarks, online_order.email]
-        # append the list_output with a list of the current order
-        list_output.append(next_row)
-
-    # create file like object in memory, which can be written to and be returned
-    buff = StringIO()
-    writer = csv.writer(buff, delimiter=';')
-    writer.writerows(list_output)
-    response = HttpResponse(buff.getvalue(), content_type='text/csv')
+    def rows():
+        # column titles
+        yield (['voornaam', 'achternaam'] + price_categories_names_list +
+               ['totaaltickets', 'totaalprijs', 'betaalmethode', 'betaald',
+                'eerste concert',
+                'marketing feedback', 'verkoper',
+                'opmerkingen', 'email'])
+        for online_order in online_orders.iterator(chunk_size=2000):
+            next_row = [online_order.first_name, online_order.last_name]
+            next_row += [getattr(online_order, name)
+                         for name in category_counts]
+            next_row += [online_order.num_tickets, online_order.total_price,
+                         online_order.payment_method,
+                         online_order.payed,
+                         bool_words.get(online_order.first_concert,
+                                        online_order.first_concert),
+                         online_order.marketing_feedback, online_order.seller,
+                         online_order.remarks, online_order.email]
+            yield next_row
+
+    # rows are written one by one while the response is streamed
+    writer = csv.writer(Echo(), delimiter=';')
+    response = StreamingHttpResponse(
+        (writer.writerow(row) for row in rows()), content_type='text/csv')
     response['content-disposition'] = 'attachment; filename="online orders - {0}.csv"'.format(
         performance)
     return response
+
+
+@login_required
+@user_passes_test(lambda u: u.is_staff, login_url='accessrestricted')
+@user_passes_test(lambda u: u.is_active, login_url='inactive')
+def export(request):
+    """Export the orders of a production and/or a range of dates."""
+    exporter = EXPORTERS.get(request.GET.get('format', 'csv'))
+    if exporter is None or not exporter.available():
+        raise Http404
+
+    production = None
+    if request.GET.get('production'):
+        try:
+            production = Production.objects.get(
+                id=request.GET['production'])
+        except Exception:
+            raise Http404
+    try:
+        start = parse_bound(request.GET.get('from', ''))
+        end = parse_bound(request.GET.get('to', ''))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    orders = select_orders(production, start, end)
+    response = StreamingHttpResponse(
+        exporter().stream(export_rows(orders)),
+        content_type=exporter.content_type)
+    response['content-disposition'] = 'attachment; filename="orders - {0}.{1}"'.format(
+        production or '{} - {}'.format(start or '...', end or '...'),
+        exporter.extension)
+    return response
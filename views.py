@@ -2,6 +2,7 @@
 
 from django.http import JsonResponse
 from django.shortcuts import render
+from django.db import transaction, IntegrityError
 from django.http import Http404
 from django.utils.timezone import now
 from django.template.loader import render_to_string
@@ -10,33 +11,30 @@ from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
 from django.utils.translation import gettext_lazy as _
 from django.utils.translation import get_language
-from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.decorators import login_required, user_passes_test
 from secrets import token_urlsafe
-from .models import Production, Performance, Ticket, Order, OnlineOrder
+from .models import Performance, Ticket, Order, OnlineOrder
 from .forms import OnlineOrderForm, TicketsForm
+from .caching import overview_data, availability_data, availability_ttl
+from .inventory import reserve_seats, hold_seats, SoldOut
+from .metrics import timed, enabled as metrics_enabled, prometheus_text
+from .outbox import queue_mail, tickets_email
+from .pdf import render_tickets_pdf, store_tickets_pdf, open_tickets_pdf
+from .scanning import build_manifest, manifest_gzip, apply_offline_scans, \
+    is_offline_scan, scan_ticket, scan_tickets
+from .scan_log import record_scans, record_offline_scans
+from .waiting_room import waiting_room, leave
 from django.views.decorators.csrf import csrf_exempt
-from weasyprint import HTML
-from django.template.loader import get_template
-from django.http import HttpResponse
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import require_POST
+from django.http import HttpResponse, FileResponse
 from datetime import datetime
+import json
 from django.shortcuts import redirect
 
 # Auxillary functions
 
 
-def _check_soldout(performance: Performance):
-    """Check if a performance is sold out or not."""
-    total_tickets = 0
-    performance_object_orders = Order.objects.filter(performance=performance)
-    for order in performance_object_orders:
-        total_tickets += order.num_tickets
-
-    if total_tickets >= performance.seats:
-        performance.active = False
-        performance.save()
-
-
 def _create_order_info(order, ticket_info, performance):
     """Create order info."""
     return {
@@ -61,66 +59,97 @@ def _create_order_info(order, ticket_info, performance):
 
 
 def _send_order_email(order: OnlineOrder, ticket_info, performance):
-    """Send a mail to confirm the order."""
-    subject = _("Confirmation Order Tickets: %s") % (
-        order.performance.production.name
-    )
-    data = _create_order_info(order, ticket_info, performance)
-    message_plain = render_to_string('ticketing/mail/order_plain.html', data)
-    message_html = render_to_string('ticketing/mail/order.html', data)
-    sender = (
-        "Alumni Arenbergorkest <noreply-ticketing@alumniarenbergorkest.be>"
-    )
-    email = EmailMultiAlternatives(
-        subject, message_plain,
-        from_email=sender,
-        to=[data['email']],
-        cc=[settings.EMAIL_WEBTEAM, settings.EMAIL_BESTUUR],
-    )
-    email.attach_alternative(message_html, "text/html")
-    try:
-        email.send()
-    except Exception:
-        import logging
-        log = logging.getLogger('django.request.mail')
-        log.error(
-            "Mail couldn't be send for order: %d" % order.id
+    """Queue a mail to confirm the order."""
+    with timed('send_order_email'):
+        subject = _("Confirmation Order Tickets: %s") % (
+            order.performance.production.name
         )
-        log.info(message_plain)
-
+        data = _create_order_info(order, ticket_info, performance)
+        message_plain = render_to_string(
+            'ticketing/mail/order_plain.html', data)
+        message_html = render_to_string('ticketing/mail/order.html', data)
+        sender = (
+            "Alumni Arenbergorkest <noreply-ticketing@alumniarenbergorkest.be>"
+        )
+        email = EmailMultiAlternatives(
+            subject, message_plain,
+            from_email=sender,
+            to=[data['email']],
+            cc=[settings.EMAIL_WEBTEAM, settings.EMAIL_BESTUUR],
+        )
+        email.attach_alternative(message_html, "text/html")
+        queue_mail(email, order)
     return data
 
 
 # HTTP pages
 def overview(request):
     """Overview of all current ticket sales."""
-    productions = Production.objects.filter(active=True)
-    subdata = []
-    for production in productions:
-        performances = list(sorted(
-            Performance.objects.filter(production=production),
-            key=lambda obj: obj.date
-        ))
-        subdata.append({
-            "production": production,
-            "performances": performances
-        })
-
+    subdata = overview_data()
     data = {
         "data": subdata,
-        "available": len(productions) > 0
+        "available": len(subdata) > 0
     }
     return render(request, 'ticketing/overview.html', data)
 
 
+def availability(request):
+    """Remaining seats of the active performances, for polling."""
+    response = JsonResponse({'performances': availability_data()})
+    patch_cache_control(response, public=True, max_age=availability_ttl())
+    return response
+
+
+def _render_confirmation(request, performance, order_id, order_hash,
+                         receipt):
+    """Confirmation page of a new order."""
+    return render(request, 'ticketing/order/confirm.html', dict(
+        receipt,
+        performance=performance,
+        # Required info for followup step:
+        order_id=order_id,
+        order_hash=order_hash,
+    ))
+
+
+def _replay_order(request, performance, order_hash):
+    """Confirmation of an order placed before, None for a new order."""
+    placed = Order.objects.filter(hash=order_hash).values_list(
+        'id', 'receipt', 'performance_id').first()
+    if placed is None:
+        return None
+    order_id, receipt, performance_id = placed
+    if performance_id != performance.id:
+        # Resubmitted on the page of another performance
+        performance = Performance.objects.select_related(
+            'production', 'location').get(id=performance_id)
+    if not receipt:
+        # Placed before the receipts were stored
+        return render(request, 'ticketing/order/repost.html', {
+            'performance': performance
+        })
+    return _render_confirmation(request, performance, order_id, order_hash,
+                                receipt)
+
+
+@waiting_room
 def order(request, id):
     """Buy a ticket."""
     try:
-        performance = Performance.objects.get(id=id)
+        # The confirmation mail shows the production and location
+        performance = Performance.objects.select_related(
+            'production', 'location').get(id=id)
     except Exception:
         raise Http404
 
-    if not performance.is_open:
+    # Submitted before: show the same confirmation again
+    if request.POST.get('hash'):
+        replay = _replay_order(request, performance, request.POST['hash'])
+        if replay is not None:
+            return replay
+
+    hold = request.POST.get('hold')
+    if not performance.is_open or not (performance.remaining_seats or hold):
         raise Http404
 
     tform = TicketsForm(performance, request.POST or None)
@@ -129,48 +158,60 @@ def order(request, id):
     if (request.POST and form.is_valid() and tform.is_valid()):
         # Create order
         order = form.save(commit=False)
-        try:
-            Order.objects.get(hash=order.hash)
-            # Already posted
-            return render(request, 'ticketing/order/repost.html', {
-                'performance': performance
-            })
-        except ObjectDoesNotExist:
-            pass
-
         order.date = now()
         order.performance = performance
         order.language = get_language()
-        order.save()
 
         # Add tickets
-        tickets = []
         ticket_info = []
-        for categ in performance.price_categories.all():
+        amounts = []
+        for categ in tform.price_categories:
             if tform.cleaned_data[categ.name]:
                 nr = tform.cleaned_data[categ.name]
                 ticket_info.append([categ.name, categ.price, nr])
-                for i in range(nr):
-                    tickets.append(Ticket(price_category=categ, order=order))
-
-        Ticket.objects.bulk_create(tickets)
-
-        # Confirm & close sales if needed
-        data = _send_order_email(order, ticket_info, performance)
-        _check_soldout(performance)
-
+                amounts.append((categ, nr))
+
+        order.ticket_count = sum(nr for categ, nr in amounts)
+        order.total_amount = sum(categ.price * nr for categ, nr in amounts)
+        order.receipt = {
+            'nr_of_tickets': order.ticket_count,
+            'total_price': order.total_amount,
+            'last_name': order.last_name,
+            'payment_method': order.payment_method,
+            'transfer_to': settings.TARGET_BANK_ACCOUNT,
+        }
+        tickets = []
+        try:
+            with transaction.atomic():
+                reserve_seats(performance, order.ticket_count, hold)
+                order.save()
+                for categ, nr in amounts:
+                    for i in range(nr):
+                        tickets.append(
+                            Ticket(price_category=categ, order=order))
+                Ticket.objects.bulk_create(tickets)
+                # Confirm
+                _send_order_email(order, ticket_info, performance)
+        except SoldOut:
+            tform.add_error(None, _(
+                "There are not enough seats left for this order."
+            ))
+            return render(request, 'ticketing/order/form.html', {
+                "form": form,
+                "tform": tform,
+                'performance': performance
+            })
+        except IntegrityError:
+            # The same form was submitted concurrently and got saved first
+            replay = _replay_order(request, performance, order.hash)
+            if replay is None:
+                raise
+            return replay
+
+        leave(request, performance.id)
         # Redirect
-        return render(request, 'ticketing/order/confirm.html', {
-            'performance': performance,
-            'nr_of_tickets': len(tickets),
-            # Required info for followup step:
-            'order_id': order.id,
-            'order_hash': order.hash,
-            'total_price': data['total_price'],
-            'last_name': data['last_name'],
-            'payment_method': data['payment_method'],
-            'transfer_to': data['transfer_to']
-        })
+        return _render_confirmation(request, performance, order.id,
+                                    order.hash, order.receipt)
     else:
         return render(request, 'ticketing/order/form.html', {
             "form": form,
@@ -179,62 +220,47 @@ def order(request, id):
         })
 
 
-def _create_data_and_pdf_order(request, order: OnlineOrder):
-    """Create data and pdf for an order."""
-    ticket_info = []
-    for ticket in order.tickets.all():
-        ticket_info.append((str(ticket.price_category), ticket.qr_code))
+@require_POST
+@waiting_room
+def hold(request, id):
+    """Hold the chosen seats while the buyer fills in the order form."""
+    try:
+        performance = Performance.objects.get(id=id)
+    except Exception:
+        raise Http404
 
-    data = {
-        'order_id': order.id,
-        'tickets': ticket_info,
-        'first_name': order.first_name,
-        'last_name': order.last_name,
-        'performance': order.performance,
-        'payment': order.payment_method,
-        'production_name': order.performance.production.name,
-        'location': order.performance.location,
-        'address': order.performance.location.address,
-        'date': order.performance.date.date(),
-        'time': order.performance.date.time(),
-    }
+    if not performance.is_open:
+        raise Http404
 
-    html_template = get_template('ticketing/mail/tickets_pdf.html')
-    pdf_file = HTML(
-        string=html_template.render(data),
-        base_url=request.build_absolute_uri()).write_pdf()
-    return data, pdf_file
+    tform = TicketsForm(performance, request.POST)
+    if not tform.is_valid():
+        return JsonResponse({'errors': tform.errors}, status=400)
+    try:
+        seat_hold = hold_seats(performance, tform.get_total_tickets(),
+                               request.POST.get('hold'))
+    except SoldOut:
+        return JsonResponse({'errors': {'__all__': [
+            _("There are not enough seats left for this order.")
+        ]}}, status=409)
+    return JsonResponse({
+        'hold': seat_hold.token,
+        'seats': seat_hold.seats,
+        'expires': seat_hold.expires,
+    })
 
 
-def _send_order_payed(request, order: OnlineOrder, subject: str):
-    """Send payment information."""
-    with translation.override(order.language):
-        data, pdf_file = _create_data_and_pdf_order(request, order)
-        message_plain = render_to_string(
-            'ticketing/mail/tickets_plain.html', data)
-        message_html = render_to_string(
-            'ticketing/mail/tickets.html', data)
-        sender = (
-            "Alumni Arenbergorkest <noreply-ticketing@alumniarenbergorkest.be>"
-        )
-        email = EmailMultiAlternatives(
-            subject, message_plain,
-            from_email=sender,
-            to=[order.email],
-            cc=[settings.EMAIL_WEBTEAM, settings.EMAIL_BESTUUR],
-        )
-        email.attach_alternative(message_html, "text/html")
-        email.attach("tickets.pdf", pdf_file, 'application/pdf')
+def _create_data_and_pdf_order(request, order: OnlineOrder):
+    """Create data and pdf for an order."""
+    with timed('create_data_and_pdf_order'):
+        return render_tickets_pdf(order)
 
-    try:
-        email.send()
-    except Exception:
-        import logging
-        log = logging.getLogger('django.request.mail')
-        log.error(
-            "Mail couldn't be send for order: %d" % order.id
-        )
-        log.info(message_plain)
+
+def _send_order_payed(request, order: OnlineOrder, subject: str):
+    """Queue the payment confirmation with the tickets."""
+    data, pdf_file = store_tickets_pdf(order)
+    email = tickets_email(order, data, subject)
+    email.attach("tickets.pdf", pdf_file, 'application/pdf')
+    queue_mail(email, order)
 
 
 def order_info(request, id, code):
@@ -279,9 +305,10 @@ def send_order_payed(request, id):
     subject = _("Tickets: %s") % (
         order.performance.production.name
     )
-    order.payed = True
-    order.save()
-    _send_order_payed(request, order, subject)
+    with transaction.atomic():
+        order.payed = True
+        order.save()
+        _send_order_payed(request, order, subject)
     return render(request, 'ticketing/order/mail_send.html', {
         'id': id,
         'order': order
@@ -322,19 +349,17 @@ def test_mail(request, id):
 def download_tickets(request, id, code):
     """Download tickets."""
     try:
-        order = OnlineOrder.objects.get(id=id)
+        order = OnlineOrder.objects.select_related(
+            'performance__production', 'performance__location').get(id=id)
     except Exception:
         raise Http404
 
     if order.hash != code or not order.payed:
         raise Http404
 
-    with translation.override(order.language):
-        data, pdf_file = _create_data_and_pdf_order(request, order)
-        response = HttpResponse(pdf_file, content_type='application/pdf')
-        response['Content-Disposition'] = 'filename="tickets.pdf"'
-
-    return response
+    pdf_file = open_tickets_pdf(order)
+    return FileResponse(pdf_file, content_type='application/pdf',
+                        filename='tickets.pdf')
 
 
 @login_required
@@ -384,7 +409,7 @@ def qr_info(request, id, code):
     except Exception:
         raise Http404
 
-    if code != ticket.code:
+    if code != ticket.code and code != ticket.scan_code:
         raise Http404
 
     try:
@@ -412,68 +437,117 @@ def qr_scan(request):
     return render(request, 'ticketing/qr/scan.html')
 
 
+def _performance_param(data):
+    """Performance a scanner is checking, None when not given."""
+    try:
+        return int(data.get('performance'))
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
 @csrf_exempt
 def qr_reply(request):
     """Test a QR code."""
-    code = request.POST.get('code', '')
-    items = code.split("/")
-    if len(items[-1]) > 3:
-        id = items[-2]
-        hash_code = items[-1]
-    else:
-        id = items[-3]
-        hash_code = items[-2]
+    performance = _performance_param(request.POST)
+    with timed('qr_reply'):
+        result = scan_ticket(request.POST.get('code', ''), performance)
+        record_scans([result], request.POST.get('gate', ''), performance)
+    return JsonResponse(result.as_json())
 
-    message = "Unknown (%s)" % code
-    valid = False
-    # TODO: Take into account unpayed tickets & clean up code!
-    # Use an enumerator to assign the state!
-    try:
-        ticket = Ticket.objects.get(id=id)
-        if ticket.code == hash_code:
-            try:
-                last_name = ticket.order.onlineorder.last_name
-                first_name = ticket.order.onlineorder.first_name
-                message = "%s, %s - %s (%d)" % (
-                    last_name, first_name,
-                    ticket.price_category.name,
-                    ticket.id
-                )
-            except ObjectDoesNotExist:
-                message = "?? - %s (%d)" % (
-                    ticket.price_category.name,
-                    ticket.id
-                )
-
-            valid = True
-            already_scanned = ticket.used
-            if "kassaticket" in ticket.code:
-                valid = True
-                already_scanned = False
-                message = "KASSA TICKET!"
-            elif ticket.order.performance.date.date() != datetime.now().date():
-                message += " WRONG DAY - Ticket for concert %s on %s" % (
-                    ticket.order.performance,
-                    ticket.order.performance.date.strftime("%a %d/%m/%y")
-                )
-                if already_scanned:
-                    message += " AND SCANNED!"
-                valid = False
-            elif not already_scanned and valid:
-                ticket.used = True
-                ticket.save()
-        else:
-            already_scanned = False
-            message = "Ticket is invalid!"
-            valid = False
 
-    except Exception as e:
-        valid = False
-        already_scanned = False
-        message += " " + str(e)
+def _scan_batch_size():
+    """Most codes a scanner may send at once."""
+    return getattr(settings, 'TICKETING_SCAN_BATCH_SIZE', 200)
+
 
+@csrf_exempt
+def qr_reply_batch(request):
+    """Test a batch of QR codes."""
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body)
+            codes = data['codes']
+        except (ValueError, KeyError, TypeError):
+            return JsonResponse({"error": "Invalid codes."}, status=400)
+    else:
+        data = request.POST
+        codes = request.POST.getlist('code')
+
+    if not isinstance(codes, list):
+        return JsonResponse({"error": "Invalid codes."}, status=400)
+    if len(codes) > _scan_batch_size():
+        return JsonResponse({"error": "Too many codes."}, status=400)
+
+    performance = _performance_param(data)
+    results = scan_tickets([str(code) for code in codes], performance)
+    record_scans(results, str(data.get('gate') or ''), performance)
     return JsonResponse({
-        "valid": valid,
-        "already_scanned": already_scanned,
-        "text": message,
+        "results": [result.as_json() for result in results],
     })
+
+
+@login_required
+@user_passes_test(lambda u: u.is_staff, login_url='accessrestricted')
+@user_passes_test(lambda u: u.is_active, login_url='inactive')
+def qr_manifest(request, id):
+    """Download the offline scanner manifest of a performance."""
+    try:
+        performance = Performance.objects.get(id=id)
+    except Exception:
+        raise Http404
+
+    manifest = build_manifest(performance)
+    etag = '"%s"' % manifest['version']
+    if request.headers.get('If-None-Match') == etag:
+        return HttpResponse(status=304)
+
+    response = HttpResponse(manifest_gzip(manifest),
+                            content_type='application/gzip')
+    response['Content-Disposition'] = (
+        'attachment; filename="manifest-%d.json.gz"' % performance.id)
+    response['ETag'] = etag
+    return response
+
+
+@csrf_exempt
+@login_required
+@user_passes_test(lambda u: u.is_staff, login_url='accessrestricted')
+@user_passes_test(lambda u: u.is_active, login_url='inactive')
+def qr_sync(request, id):
+    """Apply the scans recorded offline by a scanner."""
+    try:
+        performance = Performance.objects.get(id=id)
+    except Exception:
+        raise Http404
+
+    if request.method != 'POST':
+        raise Http404
+
+    # Without a CSRF token, only accept what a cross site form can't send
+    if request.content_type != 'application/json':
+        return JsonResponse({"error": "Scans must be sent as JSON."},
+                            status=400)
+
+    try:
+        scans = json.loads(request.body)['scans']
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({"error": "Invalid scans."}, status=400)
+
+    if not isinstance(scans, list) or not all(map(is_offline_scan, scans)):
+        return JsonResponse({"error": "Invalid scans."}, status=400)
+
+    outcome = apply_offline_scans(performance, scans)
+    record_offline_scans(performance, scans, outcome)
+    return JsonResponse(outcome)
+
+
+@login_required
+@user_passes_test(lambda u: u.is_staff, login_url='accessrestricted')
+@user_passes_test(lambda u: u.is_active, login_url='inactive')
+def metrics(request):
+    """Timings and query counts in the Prometheus text format."""
+    if not metrics_enabled():
+        raise Http404
+
+    return HttpResponse(prometheus_text(),
+                        content_type='text/plain; version=0.0.4')
@@ -0,0 +1,210 @@
+"""
+Waiting room in front of the order form.
+
+When sales open for a popular production only
+``TICKETING_WAITING_ROOM_CAPACITY`` buyers per performance get to the
+order form at the same time, everyone else gets a number in a signed
+cookie and a page showing their position. A buyer who is let in has
+``TICKETING_WAITING_ROOM_CHECK_IN`` seconds to reach the form (or poll
+their position), so buyers who left don't block a place for long. After
+that they keep their place for ``TICKETING_WAITING_ROOM_TTL`` seconds
+after their last request, or until their order is placed.
+
+The queue lives in the cache, so all workers have to share a cache
+backend (any backend works in tests). Only the request that gets the
+per-performance lock moves the queue forward, the others just read it.
+A capacity of 0 disables the waiting room.
+"""
+
+import time
+from functools import wraps
+from secrets import token_hex
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+from django.shortcuts import render
+from django.urls import reverse
+
+COOKIE_SALT = 'tickets.waiting_room'
+# Queues are forgotten a day after their last use
+STATE_TIMEOUT = 24 * 3600
+LOCK_TIMEOUT = 5
+
+
+def capacity():
+    """Buyers per performance allowed at the order form."""
+    return getattr(settings, 'TICKETING_WAITING_ROOM_CAPACITY', 0)
+
+
+def ttl():
+    """Seconds a buyer keeps their place at the form."""
+    return getattr(settings, 'TICKETING_WAITING_ROOM_TTL', 600)
+
+
+def check_in():
+    """Seconds a buyer who is let in has to reach the form."""
+    return getattr(settings, 'TICKETING_WAITING_ROOM_CHECK_IN', 30)
+
+
+def _key(performance_id: int, name: str):
+    return 'tickets:queue:%d:%s' % (performance_id, name)
+
+
+def _seen_key(performance_id: int, number: int):
+    return _key(performance_id, 'seen:%d' % number)
+
+
+def _cookie_name(performance_id: int):
+    return 'tickets_queue_%d' % performance_id
+
+
+def _epoch(performance_id: int):
+    """Identifies a queue, so old cookies don't match a restarted queue."""
+    key = _key(performance_id, 'epoch')
+    cache.add(key, token_hex(8), STATE_TIMEOUT)
+    return cache.get(key)
+
+
+def join(performance_id: int):
+    """Take a number at the back of the queue."""
+    key = _key(performance_id, 'next')
+    cache.add(key, 0, STATE_TIMEOUT)
+    return _epoch(performance_id), cache.incr(key)
+
+
+def queue_number(request, performance_id: int):
+    """Number of the buyer in the queue, None without a valid one."""
+    value = request.get_signed_cookie(
+        _cookie_name(performance_id), default=None, salt=COOKIE_SALT)
+    try:
+        epoch, number = value.rsplit('-', 1)
+        number = int(number)
+    except (AttributeError, ValueError):
+        return None
+    if epoch != _epoch(performance_id):
+        return None
+    return number
+
+
+def _lock(performance_id: int):
+    return cache.add(_key(performance_id, 'lock'), 1, LOCK_TIMEOUT)
+
+
+def _unlock(performance_id: int):
+    cache.delete(_key(performance_id, 'lock'))
+
+
+def queue_position(performance_id: int, number: int):
+    """
+    Let buyers in while there is room, and keep the place of the buyer.
+
+    Returns 0 when the buyer may order, the number of buyers before them
+    otherwise, or None when they lost their place.
+    """
+    leases_key = _key(performance_id, 'leases')
+    admitted_key = _key(performance_id, 'admitted')
+    current = time.time()
+    if _lock(performance_id):
+        try:
+            leases = cache.get(leases_key, {})
+            # Buyers who came by while the queue was locked
+            seen = cache.get_many([_seen_key(performance_id, n)
+                                   for n in leases])
+            leases = {n: max(expires, seen.get(
+                _seen_key(performance_id, n), 0))
+                for n, expires in leases.items()}
+            leases = {n: expires for n, expires in leases.items()
+                      if expires > current}
+            admitted = cache.get(admitted_key, 0)
+            last = cache.get(_key(performance_id, 'next'), 0)
+            while len(leases) < capacity() and admitted < last:
+                admitted += 1
+                leases[admitted] = current + check_in()
+            if number in leases:
+                leases[number] = current + ttl()
+            cache.set_many({leases_key: leases, admitted_key: admitted},
+                           STATE_TIMEOUT)
+        finally:
+            _unlock(performance_id)
+    else:
+        leases = cache.get(leases_key, {})
+        admitted = cache.get(admitted_key, 0)
+        if leases.get(number, 0) > current:
+            # Merged in the leases by the next request holding the lock
+            cache.set(_seen_key(performance_id, number), current + ttl(),
+                      ttl())
+
+    if leases.get(number, 0) > current:
+        return 0
+    if number <= admitted:
+        return None
+    return number - admitted
+
+
+def leave(request, performance_id: int):
+    """Free the place of a buyer who placed their order."""
+    number = queue_number(request, performance_id)
+    if number is None or not _lock(performance_id):
+        # The place is freed once it expires
+        return
+    try:
+        leases_key = _key(performance_id, 'leases')
+        leases = cache.get(leases_key, {})
+        leases.pop(number, None)
+        cache.set(leases_key, leases, STATE_TIMEOUT)
+        cache.delete(_seen_key(performance_id, number))
+    finally:
+        _unlock(performance_id)
+
+
+def _enter(request, performance_id: int):
+    """Queue number and position of a request, joining when needed."""
+    number = queue_number(request, performance_id)
+    position = None
+    if number is not None:
+        position = queue_position(performance_id, number)
+    if position is None:
+        epoch, number = join(performance_id)
+        position = queue_position(performance_id, number)
+        return '%s-%d' % (epoch, number), position
+    return None, position
+
+
+def _set_cookie(response, performance_id: int, value: str):
+    if value is not None:
+        response.set_signed_cookie(
+            _cookie_name(performance_id), value, salt=COOKIE_SALT,
+            max_age=STATE_TIMEOUT, httponly=True, samesite='Lax')
+    return response
+
+
+def waiting_room(view):
+    """Only let buyers through to an order view when there is room."""
+    @wraps(view)
+    def wrapper(request, id, *args, **kwargs):
+        if not capacity():
+            return view(request, id, *args, **kwargs)
+
+        value, position = _enter(request, id)
+        if position:
+            response = render(request, 'ticketing/order/waiting.html', {
+                'position': position,
+                'status_url': reverse('tickets:queue', kwargs={'id': id}),
+                'order_url': request.get_full_path(),
+            })
+        else:
+            response = view(request, id, *args, **kwargs)
+        return _set_cookie(response, id, value)
+    return wrapper
+
+
+def queue_status(request, id):
+    """Position of a waiting buyer, polled by the waiting page."""
+    if not capacity():
+        return JsonResponse({'position': 0, 'admitted': True})
+
+    value, position = _enter(request, id)
+    return _set_cookie(JsonResponse({
+        'position': position,
+        'admitted': not position,
+    }), id, value)